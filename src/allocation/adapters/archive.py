@@ -0,0 +1,143 @@
+import logging
+import time
+from datetime import date, datetime
+from typing import List
+
+from allocation.adapters.orm import (
+    allocations,
+    archived_allocations,
+    archived_batches,
+    batches,
+    order_lines,
+    products,
+)
+from sqlalchemy import DateTime, and_, literal, select
+from sqlalchemy.orm import Session, sessionmaker
+
+logger = logging.getLogger(__name__)
+
+
+def archivable(cutoff: date):
+    return and_(batches.c.available_quantity <= 0, batches.c.eta < cutoff)
+
+
+class BatchArchiver:
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        chunk_size: int = 500,
+        pause: float = 0.1,
+    ):
+        self.session_factory = session_factory
+        self.chunk_size = chunk_size
+        self.pause = pause
+
+    def archive_once(self, cutoff: date) -> int:
+        session = self.session_factory()
+        try:
+            candidates = session.execute(
+                select([batches.c.id, batches.c.sku])
+                .where(archivable(cutoff))
+                .order_by(batches.c.id)
+                .limit(self.chunk_size)
+            ).fetchall()
+            if not candidates:
+                return 0
+
+            # products before batches, like the ORM's flushes; the version
+            # bump makes loaded and cached aggregates go stale
+            session.execute(
+                products.update()
+                .where(
+                    products.c.sku.in_(sorted({row.sku for row in candidates}))
+                )
+                .values(version_number=products.c.version_number + 1)
+            )
+            batch_ids = [
+                row.id
+                for row in session.execute(
+                    select([batches.c.id])
+                    .where(
+                        and_(
+                            batches.c.id.in_([row.id for row in candidates]),
+                            archivable(cutoff),
+                        )
+                    )
+                    .with_for_update()
+                )
+            ]
+            self._move(session, batch_ids)
+            session.commit()
+            logger.debug(f"Archived {len(batch_ids)} batches")
+            return len(batch_ids)
+        finally:
+            session.close()
+
+    def run(self, cutoff: date) -> int:
+        total = 0
+        while True:
+            archived = self.archive_once(cutoff)
+            if not archived:
+                return total
+            total += archived
+            time.sleep(self.pause)
+
+    @staticmethod
+    def _move(session: Session, batch_ids: List[int]) -> None:
+        if not batch_ids:
+            return
+        session.execute(
+            archived_batches.insert().from_select(
+                [
+                    "id",
+                    "reference",
+                    "sku",
+                    "_purchased_quantity",
+                    "eta",
+                    "archived_at",
+                ],
+                select(
+                    [
+                        batches.c.id,
+                        batches.c.reference,
+                        batches.c.sku,
+                        batches.c._purchased_quantity,
+                        batches.c.eta,
+                        literal(datetime.utcnow(), DateTime),
+                    ]
+                ).where(batches.c.id.in_(batch_ids)),
+            )
+        )
+        allocated = allocations.join(
+            order_lines, order_lines.c.id == allocations.c.orderline_id
+        )
+        # archived allocations keep the id of their order line
+        session.execute(
+            archived_allocations.insert().from_select(
+                ["id", "batch_id", "orderid", "sku", "qty"],
+                select(
+                    [
+                        order_lines.c.id,
+                        allocations.c.batch_id,
+                        order_lines.c.orderid,
+                        order_lines.c.sku,
+                        order_lines.c.qty,
+                    ]
+                )
+                .select_from(allocated)
+                .where(allocations.c.batch_id.in_(batch_ids)),
+            )
+        )
+        session.execute(
+            allocations.delete().where(allocations.c.batch_id.in_(batch_ids))
+        )
+        session.execute(
+            order_lines.delete().where(
+                order_lines.c.id.in_(
+                    select([archived_allocations.c.id]).where(
+                        archived_allocations.c.batch_id.in_(batch_ids)
+                    )
+                )
+            )
+        )
+        session.execute(batches.delete().where(batches.c.id.in_(batch_ids)))
@@ -0,0 +1,93 @@
+import abc
+import itertools
+import json
+from dataclasses import asdict
+from datetime import datetime
+from typing import List, Tuple
+
+from allocation.domain import events
+from sqlalchemy.orm import sessionmaker
+
+DeadLetter = Tuple[int, str, events.Event]
+
+
+class AbstractDeadLetterStore(abc.ABC):
+    @abc.abstractmethod
+    def add(self, handler: str, event: events.Event, error: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list(self) -> List[DeadLetter]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, dead_letter_id: int) -> None:
+        raise NotImplementedError
+
+
+class InMemoryDeadLetterStore(AbstractDeadLetterStore):
+    def __init__(self):
+        self._dead_letters = []  # type: List[DeadLetter]
+        self._ids = itertools.count()
+
+    def add(self, handler: str, event: events.Event, error: str) -> None:
+        self._dead_letters.append((next(self._ids), handler, event))
+
+    def list(self) -> List[DeadLetter]:
+        return list(self._dead_letters)
+
+    def remove(self, dead_letter_id: int) -> None:
+        self._dead_letters = [
+            dead_letter
+            for dead_letter in self._dead_letters
+            if dead_letter[0] != dead_letter_id
+        ]
+
+
+class SqlAlchemyDeadLetterStore(AbstractDeadLetterStore):
+    def __init__(self, session_factory: sessionmaker):
+        self.session_factory = session_factory
+
+    def add(self, handler: str, event: events.Event, error: str) -> None:
+        session = self.session_factory()
+        try:
+            session.execute(
+                "INSERT INTO dead_letters"
+                " (handler, event_type, payload, error, failed_at)"
+                " VALUES (:handler, :event_type, :payload, :error, :failed_at)",
+                dict(
+                    handler=handler,
+                    event_type=type(event).__name__,
+                    payload=json.dumps(asdict(event)),
+                    error=error,
+                    failed_at=datetime.utcnow(),
+                ),
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    def list(self) -> List[DeadLetter]:
+        session = self.session_factory()
+        try:
+            rows = session.execute(
+                "SELECT id, handler, event_type, payload"
+                " FROM dead_letters ORDER BY id"
+            )
+            return [
+                (id_, handler, getattr(events, event_type)(**json.loads(data)))
+                for id_, handler, event_type, data in rows
+            ]
+        finally:
+            session.close()
+
+    def remove(self, dead_letter_id: int) -> None:
+        session = self.session_factory()
+        try:
+            session.execute(
+                "DELETE FROM dead_letters WHERE id = :id",
+                dict(id=dead_letter_id),
+            )
+            session.commit()
+        finally:
+            session.close()
@@ -1,2 +1,10 @@
+import asyncio
+
+
 def send_mail(*args, **kwargs):
     print(f"Sending email: {args} {kwargs}")
+
+
+async def send_mail_async(*args, **kwargs):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, lambda: send_mail(*args, **kwargs))
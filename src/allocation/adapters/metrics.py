@@ -0,0 +1,162 @@
+import abc
+import socket
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class AbstractMetrics(abc.ABC):
+    @abc.abstractmethod
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def increment(self, name: str, labels: Labels = (), value=1) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def gauge(self, name: str, value: float, labels: Labels = ()) -> None:
+        raise NotImplementedError
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class InMemoryMetrics(AbstractMetrics):
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = defaultdict(
+            Histogram
+        )
+        self.counters: Dict[Tuple[str, Labels], int] = defaultdict(int)
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        with self._lock:
+            self.histograms[name, labels].observe(value)
+
+    def increment(self, name: str, labels: Labels = (), value=1) -> None:
+        with self._lock:
+            self.counters[name, labels] += value
+
+    def gauge(self, name: str, value: float, labels: Labels = ()) -> None:
+        with self._lock:
+            self.gauges[name, labels] = value
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            histograms = [
+                dict(
+                    name=name,
+                    labels=dict(labels),
+                    count=histogram.count,
+                    sum=histogram.sum,
+                )
+                for (name, labels), histogram in self.histograms.items()
+            ]
+            values = [
+                dict(name=name, labels=dict(labels), value=value)
+                for metrics in (self.counters, self.gauges)
+                for (name, labels), value in metrics.items()
+            ]
+        return histograms + values
+
+
+class PrometheusMetrics(InMemoryMetrics):
+    def render(self) -> str:
+        with self._lock:
+            lines: List[str] = []
+            self._render_histograms(lines)
+            for kind, metrics in (
+                ("counter", self.counters),
+                ("gauge", self.gauges),
+            ):
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines.extend(
+                        f"{name}{_format(labels)} {value}"
+                        for (metric, labels), value in metrics.items()
+                        if metric == name
+                    )
+        return "\n".join(lines) + "\n"
+
+    def _render_histograms(self, lines: List[str]) -> None:
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), histogram in self.histograms.items():
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(
+                    BUCKETS + (float("inf"),), histogram.counts
+                ):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    bucket_labels = labels + (("le", le),)
+                    lines.append(
+                        f"{name}_bucket{_format(bucket_labels)} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{_format(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format(labels)} {histogram.count}")
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+class StatsdMetrics(AbstractMetrics):
+    def __init__(self, host: str, port: int = 8125, prefix="allocation"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket: Optional[socket.socket] = None
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        self._send(name, f"{value * 1000:.3f}", "ms", labels)
+
+    def increment(self, name: str, labels: Labels = (), value=1) -> None:
+        self._send(name, str(value), "c", labels)
+
+    def gauge(self, name: str, value: float, labels: Labels = ()) -> None:
+        self._send(name, str(value), "g", labels)
+
+    def _send(self, name: str, value: str, kind: str, labels: Labels) -> None:
+        tags = ",".join(f"{key}:{tag}" for key, tag in labels)
+        line = f"{self.prefix}.{name}:{value}|{kind}"
+        if tags:
+            line += f"|#{tags}"
+        if self.socket is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.socket.sendto(line.encode(), self.address)
+        except OSError:
+            # metrics are best effort and never fail a request
+            pass
+
+
+def from_settings(sink: str, host: str, port: int) -> Optional[AbstractMetrics]:
+    if sink == "prometheus":
+        return PrometheusMetrics()
+    if sink == "memory":
+        return InMemoryMetrics()
+    if sink == "statsd":
+        return StatsdMetrics(host, port)
+    return None
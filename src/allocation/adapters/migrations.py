@@ -0,0 +1,144 @@
+import logging
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from allocation.adapters.orm import metadata, schema_migrations
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+# serialises services that start together against the same database
+LOCK_ID = zlib.crc32(b"schema_migrations")
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    upgrade: Tuple[str, ...]
+    downgrade: Tuple[str, ...]
+
+
+MIGRATIONS = (
+    Migration(
+        1,
+        "product version numbers",
+        upgrade=(
+            "ALTER TABLE products"
+            " ADD COLUMN version_number INTEGER NOT NULL DEFAULT 0",
+        ),
+        downgrade=("ALTER TABLE products DROP COLUMN version_number",),
+    ),
+    Migration(
+        2,
+        "add lookup indexes",
+        upgrade=(
+            "CREATE INDEX IF NOT EXISTS ix_batches_sku ON batches (sku)",
+            "CREATE INDEX IF NOT EXISTS ix_order_lines_orderid_sku"
+            " ON order_lines (orderid, sku)",
+            "CREATE INDEX IF NOT EXISTS ix_allocations_batch_id"
+            " ON allocations (batch_id)",
+            "CREATE INDEX IF NOT EXISTS ix_allocations_view_orderid_sku"
+            " ON allocations_view (orderid, sku)",
+        ),
+        downgrade=(
+            "DROP INDEX IF EXISTS ix_allocations_view_orderid_sku",
+            "DROP INDEX IF EXISTS ix_allocations_batch_id",
+            "DROP INDEX IF EXISTS ix_order_lines_orderid_sku",
+            "DROP INDEX IF EXISTS ix_batches_sku",
+        ),
+    ),
+    Migration(
+        3,
+        "unique batch reference",
+        upgrade=(
+            "DROP INDEX IF EXISTS ix_batches_reference",
+            "CREATE UNIQUE INDEX ix_batches_reference ON batches (reference)",
+        ),
+        downgrade=(
+            "DROP INDEX IF EXISTS ix_batches_reference",
+            "CREATE INDEX ix_batches_reference ON batches (reference)",
+        ),
+    ),
+    Migration(
+        4,
+        "persisted available quantity",
+        upgrade=(
+            "ALTER TABLE batches ADD COLUMN available_quantity INTEGER",
+            "UPDATE batches SET available_quantity = _purchased_quantity"
+            " - COALESCE((SELECT SUM(order_lines.qty) FROM allocations"
+            " JOIN order_lines ON order_lines.id = allocations.orderline_id"
+            " WHERE allocations.batch_id = batches.id), 0)",
+            "CREATE INDEX IF NOT EXISTS ix_batches_allocatable"
+            " ON batches (sku, eta) WHERE available_quantity > 0",
+        ),
+        downgrade=(
+            "DROP INDEX IF EXISTS ix_batches_allocatable",
+            "ALTER TABLE batches DROP COLUMN available_quantity",
+        ),
+    ),
+)
+LATEST = MIGRATIONS[-1].version
+
+
+def current_version(connection: Connection) -> int:
+    return (
+        connection.execute(
+            select([func.max(schema_migrations.c.version)])
+        ).scalar()
+        or 0
+    )
+
+
+def migrate(engine: Engine, target: Optional[int] = None) -> List[Migration]:
+    if target is None:
+        target = LATEST
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(
+                text("SELECT pg_advisory_xact_lock(:id)"), id=LOCK_ID
+            )
+        fresh = not engine.dialect.has_table(connection, "batches")
+        metadata.create_all(connection)
+        if fresh:
+            # a new database already has the current schema
+            _record(connection, MIGRATIONS)
+
+        version = current_version(connection)
+        if target >= version:
+            steps = [m for m in MIGRATIONS if version < m.version <= target]
+            for migration in steps:
+                _execute(connection, migration.upgrade)
+            _record(connection, steps)
+        else:
+            steps = [
+                m for m in reversed(MIGRATIONS) if target < m.version <= version
+            ]
+            for migration in steps:
+                _execute(connection, migration.downgrade)
+            connection.execute(
+                schema_migrations.delete().where(
+                    schema_migrations.c.version > target
+                )
+            )
+
+    if steps:
+        logger.info(f"Migrated schema from version {version} to {target}")
+    return steps
+
+
+def _execute(connection: Connection, statements: Tuple[str, ...]) -> None:
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def _record(connection: Connection, applied: Iterable[Migration]) -> None:
+    rows = [
+        dict(version=m.version, name=m.name, applied_at=datetime.now())
+        for m in applied
+    ]
+    if rows:
+        connection.execute(schema_migrations.insert(), rows)
@@ -1,14 +1,21 @@
+import sys
+
 from allocation.domain import model
 from sqlalchemy import (
     Column,
     Date,
+    DateTime,
     ForeignKey,
+    Index,
     Integer,
     MetaData,
     String,
     Table,
+    Text,
+    event,
 )
 from sqlalchemy.orm import mapper, relationship
+from sqlalchemy.orm.attributes import set_committed_value
 
 metadata = MetaData()
 order_lines = Table(
@@ -18,27 +25,39 @@ order_lines = Table(
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
     Column("orderid", String(255)),
+    Index("ix_order_lines_orderid_sku", "orderid", "sku"),
 )
 products = Table(
     "products",
     metadata,
     Column("sku", String(255), primary_key=True),
+    Column("version_number", Integer, nullable=False, server_default="0"),
 )
 batches = Table(
     "batches",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("reference", String(255)),
-    Column("sku", String(255), ForeignKey("products.sku")),
+    Column("reference", String(255), index=True, unique=True),
+    Column("sku", String(255), ForeignKey("products.sku"), index=True),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    # NULL for rows written outside the ORM, until their next flush
+    Column("available_quantity", Integer, nullable=True),
+)
+# batches a line could still go to, in allocation order
+Index(
+    "ix_batches_allocatable",
+    batches.c.sku,
+    batches.c.eta,
+    postgresql_where=batches.c.available_quantity > 0,
+    sqlite_where=batches.c.available_quantity > 0,
 )
 allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", ForeignKey("order_lines.id")),
-    Column("batch_id", ForeignKey("batches.id")),
+    Column("batch_id", ForeignKey("batches.id"), index=True),
 )
 allocations_view = Table(
     "allocations_view",
@@ -47,6 +66,52 @@ allocations_view = Table(
     Column("sku", String(255)),
     Column("qty", Integer),
     Column("batchref", String(255)),
+    Index("ix_allocations_view_orderid_sku", "orderid", "sku"),
+)
+dead_letters = Table(
+    "dead_letters",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("handler", String(255), nullable=False),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("error", Text),
+    Column("failed_at", DateTime, nullable=False),
+)
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+)
+# delivered, fully allocated batches leave the aggregate but keep their history
+archived_batches = Table(
+    "archived_batches",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("reference", String(255), index=True),
+    Column("sku", String(255), index=True),
+    Column("_purchased_quantity", Integer, nullable=False),
+    Column("eta", Date, nullable=True),
+    Column("archived_at", DateTime, nullable=False),
+)
+archived_allocations = Table(
+    "archived_allocations",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("batch_id", ForeignKey("archived_batches.id"), index=True),
+    Column("orderid", String(255), index=True),
+    Column("sku", String(255)),
+    Column("qty", Integer, nullable=False),
+)
+schema_migrations = Table(
+    "schema_migrations",
+    metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
 )
 
 
@@ -60,7 +125,8 @@ def start_mappers():
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
-            )
+            ),
+            "_available_quantity": batches.c.available_quantity,
         },
     )
     mapper(
@@ -71,4 +137,38 @@ def start_mappers():
                 batch_mapper, primaryjoin=batches.c.sku == products.c.sku
             )
         },
+        # the domain bumps version_number; commit checks it was not
+        # changed underneath us
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
+
+
+@event.listens_for(model.OrderLine, "load")
+def receive_order_line_load(line, context):
+    # every line of an aggregate shares its sku; keep one copy of the string
+    set_committed_value(line, "sku", sys.intern(line.sku))
+
+
+@event.listens_for(model.Batch, "expire")
+def receive_batch_expire(batch, attrs):
+    if batch is not None:
+        batch.reset_allocated_quantity()
+
+
+@event.listens_for(model.Batch, "before_insert")
+@event.listens_for(model.Batch, "before_update")
+def receive_batch_flush(mapper, connection, batch):
+    # denormalised so allocation can query for batches with room
+    batch._available_quantity = batch.available_quantity
+
+
+@event.listens_for(model.Product, "expire")
+def receive_product_expire(product, attrs):
+    if product is not None:
+        product.reset_indexes()
+
+
+@event.listens_for(model.Product, "load")
+def receive_product_load(product, context):
+    product.events = []
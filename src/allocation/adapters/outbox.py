@@ -0,0 +1,78 @@
+import json
+import logging
+import time
+from dataclasses import asdict
+from datetime import datetime
+from typing import Iterable
+
+from allocation.adapters.orm import outbox
+from allocation.domain import events
+from redis import Redis
+from sqlalchemy import select
+from sqlalchemy.orm import Session, sessionmaker
+
+logger = logging.getLogger(__name__)
+
+CHANNELS = {
+    events.Allocated: "line_allocated",
+    events.Rebalanced: "line_allocated",
+}
+
+
+def add(session: Session, new_events: Iterable[events.Event]) -> None:
+    rows = [
+        dict(
+            channel=CHANNELS[type(event)],
+            payload=json.dumps(asdict(event)),
+            created_at=datetime.utcnow(),
+        )
+        for event in new_events
+        if type(event) in CHANNELS
+    ]
+    if rows:
+        session.execute(outbox.insert(), rows)
+
+
+class OutboxRelay:
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        redis_client: Redis,
+        batch_size: int = 100,
+        flush_interval: float = 0.1,
+    ):
+        self.session_factory = session_factory
+        self.redis_client = redis_client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+    def relay_once(self) -> int:
+        session = self.session_factory()
+        try:
+            rows = session.execute(
+                select([outbox.c.id, outbox.c.channel, outbox.c.payload])
+                .order_by(outbox.c.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).fetchall()
+            if not rows:
+                return 0
+
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for _, channel, payload in rows:
+                pipeline.publish(channel, payload)
+            pipeline.execute()
+
+            session.execute(
+                outbox.delete().where(outbox.c.id.in_([row.id for row in rows]))
+            )
+            session.commit()
+            logger.debug(f"Relayed {len(rows)} outbox messages")
+            return len(rows)
+        finally:
+            session.close()
+
+    def run(self) -> None:
+        while True:
+            if self.relay_once() < self.batch_size:
+                time.sleep(self.flush_interval)
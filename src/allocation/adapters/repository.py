@@ -1,8 +1,59 @@
 import abc
-from typing import List, Protocol, Set
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Protocol, Set, Tuple
 
+from allocation.adapters import orm
 from allocation.domain import model
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.query import Query
 from sqlalchemy.orm.session import Session
+from sqlalchemy.orm.util import identity_key
+
+LAZY = "lazy"
+SELECTIN = "selectin"
+JOINED = "joined"
+AGGREGATE = "aggregate"
+
+# the domain's first fit: in-stock batches first, then by ETA
+FIRST_FIT_ORDER = "ORDER BY batches.eta IS NOT NULL, batches.eta, batches.id"
+# anything the domain has to decide is left to it: already allocated lines,
+# no batch with room, batches of unknown room, unknown skus
+FAST_PATH_GUARD = (
+    "products.sku = :sku AND :qty > 0"
+    " AND EXISTS (SELECT 1 FROM batches"
+    " WHERE batches.sku = :sku AND batches.available_quantity >= :qty)"
+    " AND NOT EXISTS (SELECT 1 FROM batches"
+    " WHERE batches.sku = :sku AND batches.available_quantity IS NULL)"
+    " AND NOT EXISTS (SELECT 1 FROM order_lines"
+    " JOIN allocations ON allocations.orderline_id = order_lines.id"
+    " WHERE order_lines.orderid = :orderid AND order_lines.sku = :sku"
+    " AND order_lines.qty = :qty)"
+)
+# one statement on Postgres; locking the product row first orders it with
+# the ORM's flushes, which also update products before batches
+ALLOCATE_LINE = (
+    "WITH product AS ("
+    " UPDATE products SET version_number = version_number + 1"
+    f" WHERE {FAST_PATH_GUARD} RETURNING sku"
+    "), batch AS ("
+    " UPDATE batches SET available_quantity = available_quantity - :qty"
+    " WHERE batches.available_quantity >= :qty AND batches.id = ("
+    " SELECT batches.id FROM batches JOIN product USING (sku)"
+    f" WHERE batches.available_quantity >= :qty {FIRST_FIT_ORDER} LIMIT 1"
+    ") RETURNING id, reference"
+    "), line AS ("
+    " INSERT INTO order_lines (orderid, sku, qty)"
+    " SELECT :orderid, :sku, :qty FROM batch RETURNING id"
+    "), allocation AS ("
+    " INSERT INTO allocations (orderline_id, batch_id)"
+    " SELECT line.id, batch.id FROM line, batch RETURNING batch_id"
+    ")"
+    " SELECT batch.reference FROM batch"
+    " JOIN allocation ON allocation.batch_id = batch.id"
+)
 
 
 class AbstractRepository(Protocol):
@@ -20,6 +71,14 @@ class AbstractRepository(Protocol):
     ) -> model.Product:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def get_for_allocation(self, line: model.OrderLine) -> model.Product:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def allocate_fast(self, line: model.OrderLine) -> Optional[model.Reference]:
+        raise NotImplementedError
+
     @abc.abstractmethod
     def list(self) -> List[model.Product]:
         raise NotImplementedError
@@ -30,49 +89,315 @@ class TrackingRepository:
 
     def __init__(self, repo: AbstractRepository):
         self._repo = repo
-        self.seen = set()  # type: Set[model.Product]
+        self.seen: Set[model.Product] = set()
 
     def add(self, product: model.Product):
         self._repo.add(product)
         self.seen.add(product)
 
-    def get(self, sku: model.Sku) -> model.Product:
-        product = self._repo.get(sku)
+    def get(self, sku: model.Sku, **options) -> model.Product:
+        product = self._repo.get(sku, **options)
         if product:
             self.seen.add(product)
         return product
 
     def get_by_batch_reference(
-        self, reference: model.Reference
+        self, reference: model.Reference, **options
     ) -> model.Product:
-        product = self._repo.get_by_batch_reference(reference)
+        product = self._repo.get_by_batch_reference(reference, **options)
         if product:
             self.seen.add(product)
         return product
 
-    def list(self) -> List[model.Product]:
-        return self._repo.list()
+    def get_for_allocation(self, line: model.OrderLine) -> model.Product:
+        product = self._repo.get_for_allocation(line)
+        if product:
+            self.seen.add(product)
+        return product
+
+    def allocate_fast(self, line: model.OrderLine) -> Optional[model.Reference]:
+        return self._repo.allocate_fast(line)
+
+    def list(self, **options) -> List[model.Product]:
+        return self._repo.list(**options)
 
 
 class SqlAlchemyRepository:
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, loading: str = SELECTIN):
         self.session = session
+        self.loading = loading
 
     def add(self, product: model.Product):
         self.session.add(product)
 
-    def get(self, sku: model.Sku) -> model.Product:
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+    def get(
+        self, sku: model.Sku, loading: Optional[str] = None
+    ) -> model.Product:
+        return self._first(model.Product.sku == sku, loading)
 
     def get_by_batch_reference(
-        self, reference: model.Reference
+        self, reference: model.Reference, loading: Optional[str] = None
     ) -> model.Product:
-        return (
-            self.session.query(model.Product)
-            .join(model.Batch)
+        sku = (
+            self.session.query(model.Batch.sku)
             .filter(model.Batch.reference == reference)
+            .limit(1)
+            .as_scalar()
+        )
+        return self._first(model.Product.sku == sku, loading)
+
+    def allocate_fast(self, line: model.OrderLine) -> Optional[model.Reference]:
+        params = dict(orderid=line.orderid, sku=line.sku, qty=line.qty)
+        if self.session.bind.dialect.name == "postgresql":
+            return self.session.execute(ALLOCATE_LINE, params).scalar()
+
+        # elsewhere the same steps, serialised by taking the product's write
+        # lock first
+        bumped = self.session.execute(
+            "UPDATE products SET version_number = version_number + 1"
+            f" WHERE {FAST_PATH_GUARD}",
+            params,
+        )
+        if not bumped.rowcount:
+            return None
+        [[batch_id, reference]] = self.session.execute(
+            "SELECT batches.id, batches.reference FROM batches"
+            " WHERE batches.sku = :sku AND batches.available_quantity >= :qty"
+            f" {FIRST_FIT_ORDER} LIMIT 1",
+            params,
+        )
+        self.session.execute(
+            "UPDATE batches SET available_quantity = available_quantity - :qty"
+            " WHERE id = :batch_id",
+            dict(params, batch_id=batch_id),
+        )
+        orderline_id = self.session.execute(
+            "INSERT INTO order_lines (orderid, sku, qty)"
+            " VALUES (:orderid, :sku, :qty)",
+            params,
+        ).lastrowid
+        self.session.execute(
+            "INSERT INTO allocations (orderline_id, batch_id)"
+            " VALUES (:orderline_id, :batch_id)",
+            dict(orderline_id=orderline_id, batch_id=batch_id),
+        )
+        return reference
+
+    def get_for_allocation(self, line: model.OrderLine) -> model.Product:
+        # a partial aggregate: the batch already holding the line, if any,
+        # and the first batch with room for it
+        product = self.session.query(model.Product).get(line.sku)
+        if product is None or "batches" not in inspect(product).unloaded:
+            return product
+
+        batches = self.session.query(model.Batch).options(
+            selectinload(model.Batch._allocations)
+        )
+        holding = (
+            batches.join(
+                orm.allocations, orm.allocations.c.batch_id == model.Batch.id
+            )
+            .join(
+                model.OrderLine,
+                model.OrderLine.id == orm.allocations.c.orderline_id,
+            )
+            .filter(
+                model.Batch.sku == line.sku,
+                model.OrderLine.orderid == line.orderid,
+                model.OrderLine.sku == line.sku,
+                model.OrderLine.qty == line.qty,
+            )
             .first()
         )
+        first_fit = (
+            batches.filter(
+                model.Batch.sku == line.sku,
+                model.Batch._available_quantity > 0,
+                model.Batch._available_quantity >= line.qty,
+            )
+            .order_by(
+                model.Batch.eta.isnot(None), model.Batch.eta, model.Batch.id
+            )
+            .first()
+        )
+        # batches written outside the ORM have no persisted room yet
+        unknown = batches.filter(
+            model.Batch.sku == line.sku,
+            model.Batch._available_quantity.is_(None),
+        ).all()
+        loaded = {b.id: b for b in (holding, first_fit, *unknown) if b}
+        set_committed_value(
+            product, "batches", [loaded[id_] for id_ in sorted(loaded)]
+        )
+        return product
 
-    def list(self):
-        return self.session.query(model.Product).all()
+    def list(self, loading: Optional[str] = None) -> List[model.Product]:
+        loading = loading or self.loading
+        if loading == AGGREGATE:
+            return self._load_aggregates()
+        return self._query(loading).all()
+
+    def _first(self, criterion, loading: Optional[str]) -> model.Product:
+        loading = loading or self.loading
+        if loading == AGGREGATE:
+            return next(iter(self._load_aggregates(criterion)), None)
+        return self._query(loading).filter(criterion).first()
+
+    def _query(self, loading: str) -> Query:
+        query = self.session.query(model.Product)
+        if loading == SELECTIN:
+            return query.options(
+                selectinload(model.Product.batches).selectinload(
+                    model.Batch._allocations
+                )
+            )
+        if loading == JOINED:
+            return query.options(
+                joinedload(model.Product.batches).joinedload(
+                    model.Batch._allocations
+                )
+            )
+        if loading == LAZY:
+            return query
+        raise ValueError(f"Unknown loading strategy {loading}")
+
+    def _load_aggregates(self, criterion=None) -> List[model.Product]:
+        # one round trip for products, batches and allocated lines
+        query = (
+            self.session.query(model.Product, model.Batch, model.OrderLine)
+            .outerjoin(model.Batch, model.Batch.sku == model.Product.sku)
+            .outerjoin(
+                orm.allocations, orm.allocations.c.batch_id == model.Batch.id
+            )
+            .outerjoin(
+                model.OrderLine,
+                model.OrderLine.id == orm.allocations.c.orderline_id,
+            )
+            .order_by(model.Product.sku, model.Batch.id)
+        )
+        if criterion is not None:
+            query = query.filter(criterion)
+
+        # keyed by sku and reference: Product.__eq__ would load batches
+        aggregates: Dict[model.Sku, Tuple[model.Product, Dict]] = {}
+        for product, batch, line in query:
+            _, batches = aggregates.setdefault(product.sku, (product, {}))
+            if batch is None:
+                continue
+            _, lines = batches.setdefault(batch.reference, (batch, set()))
+            if line is not None:
+                lines.add(line)
+
+        for product, batches in aggregates.values():
+            # leave collections alone if they were already loaded and
+            # possibly changed in this session
+            if "batches" in inspect(product).unloaded:
+                set_committed_value(
+                    product, "batches", [batch for batch, _ in batches.values()]
+                )
+            for batch, lines in batches.values():
+                if "_allocations" in inspect(batch).unloaded:
+                    set_committed_value(batch, "_allocations", lines)
+        return [product for product, _ in aggregates.values()]
+
+
+class ProductCache:
+    # detached Product graphs, checked out by one unit of work at a time
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._products: OrderedDict[model.Sku, model.Product] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._products)
+
+    def checkout(self, sku: model.Sku) -> Optional[model.Product]:
+        with self._lock:
+            product = self._products.pop(sku, None)
+            if product is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return product
+
+    def put(self, product: model.Product) -> None:
+        with self._lock:
+            self._products[product.sku] = product
+            self._products.move_to_end(product.sku)
+            while len(self._products) > self.max_size:
+                self._products.popitem(last=False)
+
+
+class CachingRepository:
+    def __init__(self, repo: SqlAlchemyRepository, cache: ProductCache):
+        self._repo = repo
+        self.session = repo.session
+        self.cache = cache
+        self._versions: Dict[model.Sku, int] = {}
+        self._products: Dict[model.Sku, model.Product] = {}
+
+    def add(self, product: model.Product):
+        self._repo.add(product)
+        self._track(product)
+
+    def get(self, sku: model.Sku, **options) -> model.Product:
+        if identity_key(model.Product, sku) in self.session.identity_map:
+            return self._repo.get(sku, **options)
+
+        product = self.cache.checkout(sku)
+        if product is not None and (
+            product.version_number == self._current_version(sku)
+        ):
+            product.events = []
+            self.session.add(product)
+        else:
+            product = self._repo.get(sku, **options)
+        if product is not None:
+            self._track(product)
+        return product
+
+    def get_by_batch_reference(
+        self, reference: model.Reference, **options
+    ) -> model.Product:
+        product = self._repo.get_by_batch_reference(reference, **options)
+        if product is not None:
+            self._track(product)
+        return product
+
+    def get_for_allocation(self, line: model.OrderLine) -> model.Product:
+        # partial aggregates never go back into the cache
+        return self._repo.get_for_allocation(line)
+
+    def allocate_fast(self, line: model.OrderLine) -> Optional[model.Reference]:
+        # bumps the version, so a cached copy of the product goes stale
+        return self._repo.allocate_fast(line)
+
+    def list(self, **options) -> List[model.Product]:
+        return self._repo.list(**options)
+
+    def committed(self, products: Iterable[model.Product]) -> None:
+        for product in products:
+            if product.sku in self._products:
+                self._track(product)
+
+    def releasable(self) -> List[model.Product]:
+        # the domain bumps version_number on every change, so a product still
+        # at its loaded or committed version matches the database
+        return [
+            product
+            for sku, product in self._products.items()
+            if product.version_number == self._versions[sku]
+        ]
+
+    def _track(self, product: model.Product) -> None:
+        self._products[product.sku] = product
+        self._versions[product.sku] = product.version_number
+
+    def _current_version(self, sku: model.Sku) -> Optional[int]:
+        return (
+            self.session.query(model.Product.version_number)
+            .filter(model.Product.sku == sku)
+            .scalar()
+        )
@@ -1,21 +1,80 @@
+import functools
 import inspect
-from typing import Callable
+from typing import Callable, Optional, Type
 
-from allocation.adapters import email, event_publisher, orm
-from allocation.service_layer import messagebus, unit_of_work, handlers
+from allocation import config
+from allocation.adapters import email, orm
+from allocation.adapters.dead_letters import (
+    AbstractDeadLetterStore,
+    InMemoryDeadLetterStore,
+    SqlAlchemyDeadLetterStore,
+)
+from allocation.adapters.metrics import AbstractMetrics
+from allocation.domain import model
+from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.service_layer.dispatch import BackgroundDispatcher
+from allocation.service_layer.reallocation import Reallocations
+from allocation.service_layer.retries import RetryScheduler
+from allocation.service_layer.sharding import ShardedMessageBus
+from allocation.service_layer.read_model import (
+    AbstractReadModel,
+    SqlAlchemyReadModel,
+)
+
+DEALLOCATION_POLICIES = {
+    "any_lines": model.any_lines,
+    "fewest_lines": model.fewest_lines,
+}
 
 
 def bootstrap(
     start_orm: bool = True,
     uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
     send_mail: Callable = email.send_mail,
-    publish: Callable = event_publisher.publish,
+    read_model: Optional[AbstractReadModel] = None,
+    retries: Optional[RetryScheduler] = None,
+    dispatcher: Optional[BackgroundDispatcher] = None,
+    metrics: Optional[AbstractMetrics] = None,
+    fast_allocation: Optional[bool] = None,
+    deallocation_policy: Optional[model.DeallocationPolicy] = None,
+    bus_class: Type[messagebus.MessageBus] = messagebus.MessageBus,
 ) -> messagebus.MessageBus:
 
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "send_mail": send_mail, "publish": publish}
+    if read_model is None:
+        read_model = SqlAlchemyReadModel(uow)
+
+    if retries is None:
+        # fake units of work have no database to keep dead letters in
+        dead_letters: AbstractDeadLetterStore = InMemoryDeadLetterStore()
+        if isinstance(uow, unit_of_work.SqlAlchemyUnitOfWork):
+            dead_letters = SqlAlchemyDeadLetterStore(uow.session_factory)
+        retries = RetryScheduler(dead_letters)
+
+    if dispatcher is None:
+        dispatcher = BackgroundDispatcher(
+            **config.get_dispatcher_settings(), retries=retries
+        )
+
+    if fast_allocation is None:
+        fast_allocation = config.get_fast_allocation()
+
+    if deallocation_policy is None:
+        deallocation_policy = DEALLOCATION_POLICIES[
+            config.get_deallocation_policy()
+        ]
+
+    reallocations = Reallocations(uow)
+    dependencies = {
+        "uow": uow,
+        "reallocations": reallocations,
+        "send_mail": send_mail,
+        "read_model": read_model,
+        "fast_allocation": fast_allocation,
+        "deallocation_policy": deallocation_policy,
+    }
     injected_event_handlers = {
         event_type: [
             inject_dependencies(event_handler, dependencies)
@@ -27,10 +86,45 @@ def bootstrap(
         command_type: inject_dependencies(command_handler, dependencies)
         for command_type, command_handler in handlers.COMMAND_HANDLERS.items()
     }
-    return messagebus.MessageBus(
+    return bus_class(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_commans_handlers,
+        buffers=[reallocations, read_model],
+        retries=retries,
+        dispatcher=dispatcher,
+        metrics=metrics,
+    )
+
+
+def bootstrap_async(
+    send_mail: Callable = email.send_mail_async,
+    **kwargs,
+) -> messagebus.AsyncMessageBus:
+    bus = bootstrap(
+        send_mail=send_mail,
+        bus_class=messagebus.AsyncMessageBus,
+        **kwargs,
+    )
+    assert isinstance(bus, messagebus.AsyncMessageBus)
+    return bus
+
+
+def bootstrap_sharded(
+    shards: int,
+    start_orm: bool = True,
+    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+    **kwargs,
+) -> ShardedMessageBus:
+    # the parent only resolves batch references; each shard bootstraps its
+    # own bus, so kwargs must be picklable
+    if start_orm:
+        orm.start_mappers()
+
+    return ShardedMessageBus(
+        functools.partial(bootstrap, start_orm=start_orm, **kwargs),
+        shards=shards,
+        uow=uow,
     )
 
 
@@ -41,4 +135,10 @@ def inject_dependencies(handler: Callable, dependencies: dict) -> Callable:
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda *args, **kwargs: handler(*args, **{**deps, **kwargs})
+
+    if not deps:
+        return handler
+
+    injected = functools.partial(handler, **deps)
+    functools.update_wrapper(injected, handler)
+    return injected
@@ -19,3 +19,48 @@ def get_redis_host_and_port():
     host = os.environ.get("REDIS_HOST", "localhost")
     port = 6379 if host == "localhost" else 6379
     return dict(host=host, port=port)
+
+
+def get_dispatcher_settings():
+    workers = int(os.environ.get("DISPATCHER_WORKERS", 4))
+    queue_size = int(os.environ.get("DISPATCHER_QUEUE_SIZE", 1000))
+    return dict(workers=workers, queue_size=queue_size)
+
+
+def get_outbox_settings():
+    batch_size = int(os.environ.get("OUTBOX_BATCH_SIZE", 100))
+    flush_interval = float(os.environ.get("OUTBOX_FLUSH_INTERVAL", 0.1))
+    return dict(batch_size=batch_size, flush_interval=flush_interval)
+
+
+def get_shard_count():
+    return int(os.environ.get("ALLOCATION_SHARDS", 0))
+
+
+def get_metrics_settings():
+    sink = os.environ.get("METRICS_SINK", "prometheus")
+    host = os.environ.get("STATSD_HOST", "localhost")
+    port = int(os.environ.get("STATSD_PORT", 8125))
+    return dict(sink=sink, host=host, port=port)
+
+
+def get_product_cache_size():
+    return int(os.environ.get("PRODUCT_CACHE_SIZE", 0))
+
+
+def get_fast_allocation():
+    return os.environ.get("ALLOCATION_FAST_PATH", "0") == "1"
+
+
+def get_deallocation_policy():
+    return os.environ.get("DEALLOCATION_POLICY", "fewest_lines")
+
+
+def get_archive_settings():
+    chunk_size = int(os.environ.get("ARCHIVE_CHUNK_SIZE", 500))
+    pause = float(os.environ.get("ARCHIVE_PAUSE", 0.1))
+    return dict(chunk_size=chunk_size, pause=pause)
+
+
+def get_archive_after_days():
+    return int(os.environ.get("ARCHIVE_AFTER_DAYS", 30))
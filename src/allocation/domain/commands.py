@@ -1,10 +1,10 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import List, Optional
 
 
 class Command:
-    pass
+    __slots__ = ()
 
 
 @dataclass
@@ -17,19 +17,34 @@ class CreateBatch(Command):
 
 @dataclass
 class ChangeBatchQuantity(Command):
+    __slots__ = ("reference", "qty")
     reference: str
     qty: int
 
 
 @dataclass
 class Allocate(Command):
+    __slots__ = ("orderid", "sku", "qty")
     orderid: str
     sku: str
     qty: int
 
 
+@dataclass
+class AllocateMany(Command):
+    __slots__ = ("lines",)
+    lines: List[Allocate]
+
+
 @dataclass
 class Deallocate(Command):
+    __slots__ = ("orderid", "sku", "qty")
     orderid: str
     sku: str
     qty: int
+
+
+@dataclass
+class Rebalance(Command):
+    __slots__ = ("sku",)
+    sku: str
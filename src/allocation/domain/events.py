@@ -2,11 +2,12 @@ from dataclasses import dataclass
 
 
 class Event:
-    pass
+    __slots__ = ()
 
 
 @dataclass
 class Allocated(Event):
+    __slots__ = ("orderid", "sku", "qty", "batchref")
     orderid: str
     sku: str
     qty: int
@@ -15,11 +16,22 @@ class Allocated(Event):
 
 @dataclass
 class Deallocated(Event):
+    __slots__ = ("orderid", "sku", "qty")
     orderid: str
     sku: str
     qty: int
 
 
+@dataclass
+class Rebalanced(Event):
+    __slots__ = ("orderid", "sku", "qty", "batchref")
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
 @dataclass
 class OutOfStock(Event):
+    __slots__ = ("sku",)
     sku: str
@@ -1,8 +1,25 @@
+from bisect import bisect_left
 from dataclasses import dataclass
 from datetime import date
-from typing import List, NewType, Optional, Set
+from typing import (
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    NewType,
+    Optional,
+    Set,
+    Tuple,
+)
 
-from allocation.domain.events import Allocated, Deallocated, Event, OutOfStock
+from allocation.domain.events import (
+    Allocated,
+    Deallocated,
+    Event,
+    OutOfStock,
+    Rebalanced,
+)
 
 Reference = NewType("Reference", str)
 Sku = NewType("Sku", str)
@@ -16,7 +33,39 @@ class OrderLine:
     qty: Quantity
 
 
+DeallocationPolicy = Callable[[Collection[OrderLine], int], List[OrderLine]]
+
+
+def any_lines(lines: Collection[OrderLine], excess: int) -> List[OrderLine]:
+    selected = []
+    for line in lines:
+        if excess <= 0:
+            break
+        selected.append(line)
+        excess -= line.qty
+    return selected
+
+
+def fewest_lines(lines: Collection[OrderLine], excess: int) -> List[OrderLine]:
+    # releasing the largest lines first frees the excess with the fewest
+    # lines; the last pick is the smallest line that still covers the rest
+    ordered = sorted(lines, key=lambda line: line.qty, reverse=True)
+    selected = []
+    for index, line in enumerate(ordered):
+        if excess <= 0:
+            break
+        if line.qty >= excess:
+            fitting = (o for o in ordered[index:] if o.qty >= excess)
+            selected.append(min(fitting, key=lambda line: line.qty))
+            break
+        selected.append(line)
+        excess -= line.qty
+    return selected
+
+
 class Batch:
+    _allocated_quantity: Optional[Quantity] = None
+
     def __init__(
         self, reference: Reference, sku: Sku, qty: Quantity, eta: Optional[date]
     ):
@@ -25,6 +74,7 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations: Set[OrderLine] = set()
+        self._allocated_quantity = Quantity(0)
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -47,34 +97,132 @@ class Batch:
 
     @property
     def allocated_quaitity(self) -> Quantity:
-        return Quantity(sum(line.qty for line in self._allocations))
+        if self._allocated_quantity is None:
+            self._allocated_quantity = self._sum_allocations()
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> Quantity:
         return Quantity(self._purchased_quantity - self.allocated_quaitity)
 
     def allocate(self, line: OrderLine) -> None:
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            allocated = self.allocated_quaitity
             self._allocations.add(line)
+            self._allocated_quantity = Quantity(allocated + line.qty)
 
     def deallocate(self, line: OrderLine) -> None:
         if line in self._allocations:
+            allocated = self.allocated_quaitity
             self._allocations.remove(line)
+            self._allocated_quantity = Quantity(allocated - line.qty)
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and 0 < line.qty <= self.available_quantity
 
     def deallocate_one(self) -> Optional[OrderLine]:
         if self._allocations:
-            return self._allocations.pop()
+            allocated = self.allocated_quaitity
+            line = self._allocations.pop()
+            self._allocated_quantity = Quantity(allocated - line.qty)
+            return line
+
+    def reset_allocated_quantity(self) -> None:
+        self._allocated_quantity = None
+
+    def has_consistent_allocated_quantity(self) -> bool:
+        return self.allocated_quaitity == self._sum_allocations()
+
+    def _sum_allocations(self) -> Quantity:
+        return Quantity(sum(line.qty for line in self._allocations))
+
+
+def allocation_priority(batch: Batch) -> Tuple[bool, date]:
+    # in-stock batches first, then by ETA
+    return (batch.eta is not None, batch.eta or date.min)
+
+
+class AllocatableBatches:
+    def __init__(self, batches: Iterable[Batch]):
+        self._entries = []  # type: List[Tuple[bool, date, int, Batch]]
+        self._sequence = {}  # type: Dict[int, int]
+        for batch in batches:
+            self.update(batch)
+
+    def __iter__(self):
+        return (entry[-1] for entry in self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, batch: Batch) -> None:
+        entry = self._entry(batch)
+        index = bisect_left(self._entries, entry)
+        present = index < len(self._entries) and self._entries[index] == entry
+        if batch.available_quantity > 0 and not present:
+            self._entries.insert(index, entry)
+        elif batch.available_quantity <= 0 and present:
+            del self._entries[index]
+
+    def first_fit(self, line: OrderLine) -> Optional[Batch]:
+        return next((b for b in self if b.can_allocate(line)), None)
+
+    def _entry(self, batch: Batch) -> Tuple[bool, date, int, Batch]:
+        # ties keep the order in which batches were added
+        sequence = self._sequence.setdefault(id(batch), len(self._sequence))
+        return (*allocation_priority(batch), sequence, batch)
+
+
+class FirstFitTree:
+    def __init__(
+        self, batches: List[Batch], quantities: Optional[List[int]] = None
+    ):
+        if quantities is None:
+            quantities = [batch.available_quantity for batch in batches]
+        self.batches = batches
+        self._positions = {id(batch): i for i, batch in enumerate(batches)}
+        self._size = 1
+        while self._size < len(batches):
+            self._size *= 2
+        self._tree = [0] * (2 * self._size)
+        self._tree[self._size : self._size + len(quantities)] = quantities
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = max(
+                self._tree[2 * node], self._tree[2 * node + 1]
+            )
+
+    def first_fit(self, qty: Quantity) -> Optional[Batch]:
+        if qty <= 0 or self._tree[1] < qty:
+            return None
+        node = 1
+        while node < self._size:
+            node = 2 * node if self._tree[2 * node] >= qty else 2 * node + 1
+        return self.batches[node - self._size]
+
+    def quantities(self) -> List[int]:
+        return self._tree[self._size : self._size + len(self.batches)]
+
+    def take(self, batch: Batch, qty: Quantity) -> None:
+        node = self._size + self._positions[id(batch)]
+        self._tree[node] -= qty
+        node //= 2
+        while node:
+            self._tree[node] = max(
+                self._tree[2 * node], self._tree[2 * node + 1]
+            )
+            node //= 2
 
 
 class Product:
     events: List[Event] = []
+    _allocatable: Optional[AllocatableBatches] = None
+    _batches_by_line: Optional[Dict[OrderLine, Batch]] = None
+    _batches_by_reference: Optional[Dict[Reference, Batch]] = None
 
-    def __init__(self, sku: Sku, batches: List[Batch]):
+    def __init__(self, sku: Sku, batches: List[Batch], version_number=0):
         self.sku = sku
         self.batches = batches
+        self.version_number = version_number
         self.events = []  # type: List[Event]
 
     def __repr__(self):
@@ -91,31 +239,157 @@ class Product:
     def __gt__(self, other) -> bool:
         return len(self.batches) > len(other.batches)
 
+    @property
+    def allocatable_batches(self) -> AllocatableBatches:
+        if self._allocatable is None:
+            self._allocatable = AllocatableBatches(self.batches)
+        return self._allocatable
+
+    @property
+    def batches_by_line(self) -> Dict[OrderLine, Batch]:
+        if self._batches_by_line is None:
+            self._batches_by_line = {
+                line: batch
+                for batch in self.batches
+                for line in batch._allocations
+            }
+        return self._batches_by_line
+
+    @property
+    def batches_by_reference(self) -> Dict[Reference, Batch]:
+        if self._batches_by_reference is None:
+            self._batches_by_reference = {
+                batch.reference: batch for batch in self.batches
+            }
+        return self._batches_by_reference
+
+    def reset_indexes(self) -> None:
+        self._allocatable = None
+        self._batches_by_line = None
+        self._batches_by_reference = None
+
+    def add_batch(self, batch: Batch) -> None:
+        self.batches.append(batch)
+        self.version_number += 1
+        if self._allocatable is not None:
+            self._allocatable.update(batch)
+        if self._batches_by_reference is not None:
+            self._batches_by_reference[batch.reference] = batch
+
     def allocate(self, line: OrderLine) -> Reference:
-        try:
-            batch = next(
-                b for b in sorted(self.batches) if b.can_allocate(line)
-            )
-        except StopIteration:
+        if line in self.batches_by_line:
+            return self.batches_by_line[line].reference
+
+        batch = self.allocatable_batches.first_fit(line)
+        if batch is None:
             self.events.append(OutOfStock(line.sku))
             return None
 
+        self._allocate_to(batch, line)
+        return batch.reference
+
+    def allocate_many(
+        self, lines: Iterable[OrderLine]
+    ) -> List[Optional[Reference]]:
+        tree = FirstFitTree(list(self.allocatable_batches))
+        references = []  # type: List[Optional[Reference]]
+        for line in lines:
+            if line in self.batches_by_line:
+                references.append(self.batches_by_line[line].reference)
+                continue
+
+            batch = tree.first_fit(line.qty) if line.sku == self.sku else None
+            if batch is None:
+                self.events.append(OutOfStock(line.sku))
+                references.append(None)
+                continue
+
+            self._allocate_to(batch, line)
+            tree.take(batch, line.qty)
+            references.append(batch.reference)
+
+        return references
+
+    def rebalance(self) -> int:
+        # repack allocated lines into the earliest batch they fit, keeping the
+        # result only if it leaves larger free blocks. Lines go batch by batch,
+        # largest first, so a batch always has room left for its own lines
+        # and none can be moved onto a later delivery
+        batches = sorted(self.batches, key=allocation_priority)
+        tree = FirstFitTree(
+            batches, [batch._purchased_quantity for batch in batches]
+        )
+        positions = {id(batch): i for i, batch in enumerate(batches)}
+        lines = sorted(
+            self.batches_by_line,
+            key=lambda line: (
+                positions[id(self.batches_by_line[line])],
+                -line.qty,
+            ),
+        )
+        assignment = {}  # type: Dict[OrderLine, Batch]
+        for line in lines:
+            batch = tree.first_fit(line.qty)
+            if batch is None:
+                return 0
+            tree.take(batch, line.qty)
+            assignment[line] = batch
+
+        free_blocks = sorted(tree.quantities(), reverse=True)
+        current_blocks = sorted(
+            (batch.available_quantity for batch in batches), reverse=True
+        )
+        if free_blocks <= current_blocks:
+            return 0
+
+        moves = [
+            (line, self.batches_by_line[line], batch)
+            for line, batch in assignment.items()
+            if batch is not self.batches_by_line[line]
+        ]
+        for line, old_batch, _ in moves:
+            old_batch.deallocate(line)
+        for line, old_batch, new_batch in moves:
+            new_batch.allocate(line)
+            self.batches_by_line[line] = new_batch
+            self.events.append(
+                Rebalanced(
+                    line.orderid, line.sku, line.qty, new_batch.reference
+                )
+            )
+        self._allocatable = None
+        self.version_number += 1
+
+        return len(moves)
+
+    def _allocate_to(self, batch: Batch, line: OrderLine) -> None:
         batch.allocate(line)
+        self.version_number += 1
+        self.batches_by_line[line] = batch
+        self.allocatable_batches.update(batch)
         self.events.append(
             Allocated(line.orderid, line.sku, line.qty, batch.reference)
         )
 
-        return batch.reference
-
     def deallocate(self, line: OrderLine) -> None:
-        for batch in self.batches:
+        batch = self.batches_by_line.pop(line, None)
+        if batch is not None:
             batch.deallocate(line)
+            self.allocatable_batches.update(batch)
+            self.version_number += 1
 
     def change_batch_quantity(
-        self, reference: Reference, qty: Quantity
+        self,
+        reference: Reference,
+        qty: Quantity,
+        policy: DeallocationPolicy = fewest_lines,
     ) -> None:
-        batch = next(b for b in self.batches if b.reference == reference)
+        batch = self.batches_by_reference[reference]
         batch._purchased_quantity = qty
-        while batch.allocated_quaitity > qty:
-            line = batch.deallocate_one()
+        self.version_number += 1
+        excess = batch.allocated_quaitity - qty
+        for line in policy(batch._allocations, excess):
+            batch.deallocate(line)
+            self.batches_by_line.pop(line, None)
             self.events.append(Deallocated(line.orderid, line.sku, line.qty))
+        self.allocatable_batches.update(batch)
@@ -0,0 +1,21 @@
+import logging
+from datetime import date, timedelta
+
+from allocation import config
+from allocation.adapters.archive import BatchArchiver
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    archiver = BatchArchiver(
+        unit_of_work.DEFAULT_SESSION_FACTORY, **config.get_archive_settings()
+    )
+    cutoff = date.today() - timedelta(days=config.get_archive_after_days())
+    archived = archiver.run(cutoff)
+    logger.info(f"Archived {archived} batches delivered before {cutoff}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import atexit
 import json
 import logging
 
@@ -11,6 +12,7 @@ redis_client = Redis(**config.get_redis_host_and_port())
 
 def main():
     messagebus = bootstrap.bootstrap()
+    atexit.register(messagebus.shutdown)
     pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe("change_batch_quantity")
 
@@ -1,12 +1,28 @@
+import atexit
+import json
 from datetime import datetime
 
-from allocation import bootstrap, views
+from allocation import bootstrap, config, views
+from allocation.adapters import metrics as metrics_sinks
 from allocation.domain import commands
 from allocation.service_layer import handlers, unit_of_work
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 
 app = Flask(__name__)
-messagebus = bootstrap.bootstrap()
+metrics = metrics_sinks.from_settings(**config.get_metrics_settings())
+if config.get_shard_count():
+    # shards run in their own processes, only StatsD can see them
+    messagebus = bootstrap.bootstrap_sharded(
+        config.get_shard_count(),
+        metrics=(
+            metrics
+            if isinstance(metrics, metrics_sinks.StatsdMetrics)
+            else None
+        ),
+    )
+else:
+    messagebus = bootstrap.bootstrap(metrics=metrics)
+atexit.register(messagebus.shutdown)
 
 
 @app.route("/add_batch", methods=["POST"])
@@ -45,6 +61,50 @@ def allocate_endpoint():
     return {"message": "OK"}, 202
 
 
+@app.route("/allocate_many", methods=["POST"])
+def allocate_many_endpoint():
+    try:
+        if request.mimetype == "application/x-ndjson":
+            body = [
+                json.loads(line)
+                for line in request.get_data(as_text=True).splitlines()
+                if line.strip()
+            ]
+        else:
+            body = request.get_json(force=True, silent=True)
+    except ValueError:
+        body = None
+
+    if body is None:
+        return {"message": "Invalid JSON"}, 400
+
+    try:
+        lines = [
+            commands.Allocate(line["orderid"], line["sku"], line["qty"])
+            for line in body
+        ]
+    except (KeyError, TypeError):
+        return {"message": "Expected a list of order lines"}, 400
+
+    try:
+        results = messagebus.handle(commands.AllocateMany(lines))
+        batchrefs = results.pop(0)
+    except handlers.InvalidSku as e:
+        return {"message": str(e)}, 400
+
+    return {
+        "allocations": [
+            {
+                "orderid": line.orderid,
+                "sku": line.sku,
+                "qty": line.qty,
+                "batchref": batchref,
+            }
+            for line, batchref in zip(lines, batchrefs)
+        ]
+    }, 202
+
+
 @app.route("/deallocate", methods=["POST"])
 def deallocate_endpoint():
     try:
@@ -65,3 +125,36 @@ def allocations_view_endpoint(orderid):
     if not result:
         return {"message": "Not found"}, 404
     return jsonify(result), 200
+
+
+@app.route("/batches/<reference>/history", methods=["GET"])
+def batch_history_endpoint(reference):
+    uow = unit_of_work.SqlAlchemyUnitOfWork()
+    result = views.batch_history(reference, uow)
+    if result is None:
+        return {"message": "Not found"}, 404
+    return jsonify(result), 200
+
+
+@app.route("/products/<sku>/history", methods=["GET"])
+def product_history_endpoint(sku):
+    uow = unit_of_work.SqlAlchemyUnitOfWork()
+    result = views.product_history(sku, uow)
+    if not result:
+        return {"message": "Not found"}, 404
+    return jsonify(result), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not isinstance(metrics, metrics_sinks.InMemoryMetrics):
+        return {"message": "Metrics are not collected in-process"}, 404
+
+    dispatcher = getattr(messagebus, "dispatcher", None)
+    if dispatcher is not None:
+        for name, value in dispatcher.metrics().items():
+            metrics.gauge(f"dispatcher_{name}", value)
+
+    if isinstance(metrics, metrics_sinks.PrometheusMetrics):
+        return Response(metrics.render(), mimetype="text/plain")
+    return jsonify(metrics.snapshot()), 200
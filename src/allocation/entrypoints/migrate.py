@@ -0,0 +1,17 @@
+import logging
+
+from allocation import config
+from allocation.adapters import migrations
+from sqlalchemy import create_engine
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    engine = create_engine(config.get_postgres_uri())
+    applied = migrations.migrate(engine)
+    logger.info(f"Applied {len(applied)} migrations")
+
+
+if __name__ == "__main__":
+    main()
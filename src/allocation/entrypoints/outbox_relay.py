@@ -0,0 +1,22 @@
+import logging
+
+from allocation import config
+from allocation.adapters import event_publisher, orm
+from allocation.adapters.outbox import OutboxRelay
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    orm.start_mappers()
+    relay = OutboxRelay(
+        unit_of_work.DEFAULT_SESSION_FACTORY,
+        event_publisher.redis_client,
+        **config.get_outbox_settings(),
+    )
+    relay.run()
+
+
+if __name__ == "__main__":
+    main()
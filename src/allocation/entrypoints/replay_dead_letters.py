@@ -0,0 +1,15 @@
+import logging
+
+from allocation import bootstrap
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    messagebus = bootstrap.bootstrap()
+    replayed = messagebus.replay_dead_letters()
+    logger.info(f"Replayed {replayed} dead letters")
+
+
+if __name__ == "__main__":
+    main()
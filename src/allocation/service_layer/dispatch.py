@@ -0,0 +1,96 @@
+import asyncio
+import inspect
+import logging
+import queue
+import threading
+from typing import Callable, Dict, List, Optional
+
+from allocation.domain import events
+from allocation.service_layer.retries import RetryScheduler
+
+logger = logging.getLogger(__name__)
+
+
+def fire_and_forget(handler: Callable) -> Callable:
+    handler.fire_and_forget = True  # type: ignore
+    return handler
+
+
+def is_fire_and_forget(handler: Callable) -> bool:
+    return getattr(handler, "fire_and_forget", False)
+
+
+class BackgroundDispatcher:
+    def __init__(
+        self,
+        workers: int = 4,
+        queue_size: int = 1000,
+        retries: Optional[RetryScheduler] = None,
+    ):
+        self.workers = workers
+        self.retries = retries
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._counts = dict(submitted=0, completed=0, failed=0, ran_inline=0)
+
+    def submit(self, handler: Callable, event: events.Event) -> None:
+        self._start_workers()
+        try:
+            self._queue.put_nowait((handler, event))
+            self._count("submitted")
+        except queue.Full:
+            # apply back-pressure by running on the caller's thread
+            self._count("ran_inline")
+            self._run(handler, event)
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts, queue_depth=self._queue.qsize())
+
+    def shutdown(self) -> None:
+        self._queue.join()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _start_workers(self) -> None:
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name=f"dispatcher-{len(self._threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._run(*item)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, handler: Callable, event: events.Event) -> None:
+        try:
+            logger.debug(f"Handling event in background: {event}")
+            result = handler(event)
+            if inspect.iscoroutine(result):
+                asyncio.run(result)
+            self._count("completed")
+        except Exception as e:
+            logger.exception(f"Error handling event: {event}")
+            self._count("failed")
+            if self.retries is not None:
+                self.retries.schedule(handler, event, error=repr(e))
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
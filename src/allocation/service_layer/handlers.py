@@ -1,8 +1,10 @@
-from dataclasses import asdict
-from typing import Callable
+from typing import Callable, Dict, List, Optional
 
 from allocation.domain import commands, events, model
 from allocation.service_layer import unit_of_work
+from allocation.service_layer.dispatch import fire_and_forget
+from allocation.service_layer.read_model import AbstractReadModel
+from allocation.service_layer.reallocation import Reallocations
 
 
 class InvalidSku(Exception):
@@ -21,44 +23,87 @@ def add_batch(
         if product is None:
             product = model.Product(sku, [])
             uow.products.add(product)
-        product.batches.append(batch)
+        product.add_batch(batch)
         uow.commit()
 
 
 def change_batch_quantity(
-    message: commands.ChangeBatchQuantity, uow: unit_of_work.AbstractUnitOfWork
+    message: commands.ChangeBatchQuantity,
+    uow: unit_of_work.AbstractUnitOfWork,
+    deallocation_policy: model.DeallocationPolicy = model.fewest_lines,
 ):
     with uow:
         product = uow.products.get_by_batch_reference(
             reference=message.reference
         )
         product.change_batch_quantity(
-            reference=message.reference, qty=message.qty
+            reference=message.reference,
+            qty=message.qty,
+            policy=deallocation_policy,
         )
         uow.commit()
 
 
 def allocate(
-    message: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork
+    message: commands.Allocate,
+    uow: unit_of_work.AbstractUnitOfWork,
+    fast_allocation: bool = False,
 ) -> str:
     line = model.OrderLine(message.orderid, message.sku, message.qty)
 
     with uow:
-        product = uow.products.get(sku=message.sku)
+        batchref = uow.products.allocate_fast(line) if fast_allocation else None
+        if batchref is not None:
+            uow.events.append(
+                events.Allocated(line.orderid, line.sku, line.qty, batchref)
+            )
+        else:
+            product = uow.products.get_for_allocation(line)
+
+            if product is None:
+                raise InvalidSku(f"Invalid sku {line.sku}")
+
+            batchref = product.allocate(line)
+        uow.commit()
+
+    return batchref
 
-        if product is None:
-            raise InvalidSku(f"Invalid sku {line.sku}")
 
-        batchref = product.allocate(line)
+def allocate_many(
+    message: commands.AllocateMany, uow: unit_of_work.AbstractUnitOfWork
+) -> List[Optional[str]]:
+    positions_by_sku: Dict[str, List[int]] = {}
+    for position, line in enumerate(message.lines):
+        positions_by_sku.setdefault(line.sku, []).append(position)
+
+    batchrefs: List[Optional[str]] = [None] * len(message.lines)
+    with uow:
+        products = {sku: uow.products.get(sku=sku) for sku in positions_by_sku}
+        for sku, product in products.items():
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+
+        for sku, positions in positions_by_sku.items():
+            lines = [
+                model.OrderLine(
+                    message.lines[i].orderid, sku, message.lines[i].qty
+                )
+                for i in positions
+            ]
+            allocations = products[sku].allocate_many(lines)
+            for position, batchref in zip(positions, allocations):
+                batchrefs[position] = batchref
         uow.commit()
 
-    return batchref
+    return batchrefs
 
 
 def reallocate(
-    message: events.Deallocated, uow: unit_of_work.AbstractUnitOfWork
+    message: events.Deallocated, reallocations: Reallocations
 ) -> None:
-    allocate(commands.Allocate(**asdict(message)), uow)
+    reallocations.add(
+        model.OrderLine(message.orderid, message.sku, message.qty)
+    )
 
 
 def deallocate(
@@ -75,60 +120,58 @@ def deallocate(
         uow.commit()
 
 
-def publish_allocated_event(
-    message: events.Allocated, publish: Callable
-) -> None:
-    publish("line_allocated", message)
+def rebalance(
+    message: commands.Rebalance, uow: unit_of_work.AbstractUnitOfWork
+) -> int:
+    with uow:
+        product = uow.products.get(sku=message.sku)
+
+        if product is None:
+            raise InvalidSku(f"Invalid sku {message.sku}")
+
+        moved = product.rebalance()
+        uow.commit()
+
+    return moved
 
 
 def send_out_of_stock_notification(
     message: events.OutOfStock, send_mail: Callable
-) -> None:
-    send_mail("stock-admin@made.com", f"Out of stock: {message.sku}")
+):
+    return send_mail("stock-admin@made.com", f"Out of stock: {message.sku}")
 
 
 def add_allocation_to_read_model(
-    message: events.Allocated, uow: unit_of_work.AbstractUnitOfWork
+    message: events.Allocated, read_model: AbstractReadModel
 ):
-    with uow:
-        uow.session.execute(
-            "INSERT INTO allocations_view (orderid, sku, qty, batchref)"
-            " VALUES (:orderid, :sku, :qty, :batchref)",
-            {
-                "orderid": message.orderid,
-                "sku": message.sku,
-                "qty": message.qty,
-                "batchref": message.batchref,
-            },
-        )
-        uow.commit()
+    read_model.add_allocation(
+        message.orderid, message.sku, message.qty, message.batchref
+    )
 
 
 def remove_allocation_from_read_model(
-    message: events.Deallocated, uow: unit_of_work.AbstractUnitOfWork
+    message: events.Deallocated, read_model: AbstractReadModel
 ):
-    with uow:
-        uow.session.execute(
-            "DELETE FROM allocations_view"
-            " WHERE orderid = :orderid AND sku = :sku",
-            {
-                "orderid": message.orderid,
-                "sku": message.sku,
-            },
-        )
-        uow.commit()
+    read_model.remove_allocation(message.orderid, message.sku)
+
+
+def move_allocation_in_read_model(
+    message: events.Rebalanced, read_model: AbstractReadModel
+):
+    read_model.remove_allocation(message.orderid, message.sku)
+    read_model.add_allocation(
+        message.orderid, message.sku, message.qty, message.batchref
+    )
 
 
 EVENT_HANDLERS = {
-    events.Allocated: [
-        publish_allocated_event,
-        add_allocation_to_read_model,
-    ],
+    events.Allocated: [add_allocation_to_read_model],
     events.Deallocated: [
         reallocate,
         remove_allocation_from_read_model,
     ],
-    events.OutOfStock: [send_out_of_stock_notification],
+    events.Rebalanced: [move_allocation_in_read_model],
+    events.OutOfStock: [fire_and_forget(send_out_of_stock_notification)],
 }
 
 
@@ -136,5 +179,7 @@ COMMAND_HANDLERS = {
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.Deallocate: deallocate,
+    commands.Rebalance: rebalance,
 }
@@ -1,63 +1,419 @@
+import asyncio
+import inspect
 import logging
-from typing import Any, Callable, Dict, List, Type, Union
+import time
+from collections import deque
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Protocol,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+)
 
+from allocation.adapters.metrics import AbstractMetrics, Labels
 from allocation.domain import commands, events
 from allocation.service_layer import unit_of_work
-from tenacity import RetryError, Retrying, stop_after_attempt, wait_exponential
+from allocation.service_layer.dispatch import (
+    BackgroundDispatcher,
+    is_fire_and_forget,
+)
+from allocation.service_layer.retries import RetryScheduler, handler_name
+from tenacity import (
+    AsyncRetrying,
+    BaseRetrying,
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 Message = Union[commands.Command, events.Event]
 logger = logging.getLogger(__name__)
 
 
+class Buffer(Protocol):
+    def __len__(self) -> int: ...
+
+    def flush(self) -> None: ...
+
+    def clear(self) -> None: ...
+
+
 class MessageBus:
     def __init__(
         self,
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        buffers: Sequence[Buffer] = (),
+        retries: Optional[RetryScheduler] = None,
+        dispatcher: Optional[BackgroundDispatcher] = None,
+        metrics: Optional[AbstractMetrics] = None,
+        conflict_attempts: int = 5,
     ) -> None:
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
-        self.queue = []  # type: List[Message]
+        self.buffers = buffers
+        self.retries = retries
+        self.dispatcher = dispatcher
+        self.metrics = metrics
+        self.conflict_attempts = conflict_attempts
+        self._label_cache: Dict[Tuple[type, Callable], Labels] = {}
+        # which handlers filled each buffer since it was last flushed
+        self._buffered: List[List[Tuple[Callable, events.Event]]] = [
+            [] for _ in buffers
+        ]
+        # failed flushes so far, and when each buffer may be flushed again
+        self._flush_failures = [0 for _ in buffers]
+        self._flush_after = [0.0 for _ in buffers]
+        self.routes: Dict[Type, Callable] = {
+            **{event_type: self.handle_event for event_type in event_handlers},
+            **{
+                command_type: self.handle_command
+                for command_type in command_handlers
+            },
+        }
+
+    def route(self, message: Message) -> Callable:
+        try:
+            return self.routes[type(message)]
+        except KeyError:
+            raise TypeError(f"Unknown message type {type(message)}")
 
     def handle(self, message: Message) -> List:
         results = []
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                result = self.handle_command(message)
-                results.append(result)
-            else:
-                raise TypeError(f"Unknown message type {type(message)}")
+        queue: Deque[Message] = deque([message])
+        depth_labels = (("message", type(message).__name__),)
+        peak_depth = 1
+        try:
+            while queue:
+                peak_depth = max(peak_depth, len(queue))
+                message = queue.popleft()
+                result = self.route(message)(message, queue)
+                if isinstance(message, commands.Command):
+                    results.append(result)
+
+                if not queue:
+                    self.flush_buffers(queue)
+        finally:
+            if self.metrics is not None:
+                self.metrics.gauge(
+                    "messagebus_queue_depth", peak_depth, depth_labels
+                )
 
         return results
 
-    def handle_event(self, event: events.Event) -> None:
-        for handler in self.event_handlers[type(event)]:
+    def flush_buffers(self, queue: Deque[Message]) -> None:
+        for i, (buffer, buffered) in enumerate(
+            zip(self.buffers, self._buffered)
+        ):
+            if not buffer:
+                buffered.clear()
+                continue
+            if self._flush_failures[i] and self._now() < self._flush_after[i]:
+                # rows added since queue up behind the ones that failed
+                continue
             try:
-                for attempt in Retrying(
-                    stop=stop_after_attempt(3),
-                    wait=wait_exponential(multiplier=2),
-                ):
+                logger.debug(f"Flushing buffer: {buffer}")
+                for attempt in self._retry_conflicts(Retrying):
                     with attempt:
-                        logger.debug(f"Handling event: {event}")
-                        handler(event)
-                        self.queue.extend(self.uow.collect_new_events())
-            except RetryError as retry_failure:
-                logger.error(f"Retry error: {retry_failure}")
+                        buffer.flush()
+            except Exception as e:
+                logger.exception(f"Error flushing buffer: {buffer}")
+                # whatever the flush raised was rolled back with it
+                list(self.uow.collect_new_events())
+                self._flush_failed(i, e)
+                continue
+            self._flush_failures[i] = 0
+            buffered.clear()
+            queue.extend(self.uow.collect_new_events())
+            if queue:
+                return
+
+    def _flush_failed(self, i: int, error: Exception) -> None:
+        # the buffer kept its rows; flush it again on a later cycle, on this
+        # thread and through this unit of work, so nothing overtakes them
+        buffer, buffered = self.buffers[i], self._buffered[i]
+        self._flush_failures[i] += 1
+        if self.metrics is not None:
+            self.metrics.increment("messagebus_flush_failures_total")
+        if self.retries is None:
+            buffer.clear()
+            buffered.clear()
+            self._flush_failures[i] = 0
+            return
+        if self._flush_failures[i] < self.retries.max_attempts:
+            self._flush_after[i] = self._now() + self.retries.delay(
+                self._flush_failures[i]
+            )
+            return
+
+        for handler, event in buffered:
+            self.retries.dead_letter(handler, event, repr(error))
+        buffer.clear()
+        buffered.clear()
+        self._flush_failures[i] = 0
+
+    def handle_event(self, event: events.Event, queue: Deque[Message]) -> None:
+        for handler in self.event_handlers[type(event)]:
+            if self._dispatch_in_background(handler, event):
                 continue
+            try:
+                logger.debug(f"Handling event: {event}")
+                sizes = [len(buffer) for buffer in self.buffers]
+                self._call(handler, event)
+                self._record_buffered(handler, event, sizes)
+                queue.extend(self.uow.collect_new_events())
+            except Exception as e:
+                logger.exception(f"Error handling event: {event}")
+                self._schedule_retry(handler, event, e)
+
+    def _now(self) -> float:
+        if self.retries is None:
+            return time.monotonic()
+        return self.retries.clock()
+
+    def _record_buffered(
+        self, handler: Callable, event: events.Event, sizes: List[int]
+    ) -> None:
+        for size, buffer, buffered in zip(sizes, self.buffers, self._buffered):
+            if len(buffer) > size:
+                buffered.append((handler, event))
+
+    def _schedule_retry(
+        self, handler: Callable, event: events.Event, error: Exception
+    ) -> None:
+        if self.retries is None:
+            return
+        self.retries.schedule(handler, event, error=repr(error))
+        if self.metrics is not None:
+            self.metrics.increment(
+                "messagebus_handler_retries_total",
+                self._labels(handler, event),
+            )
+
+    def _retry_conflicts(self, retrying: Type[BaseRetrying]) -> BaseRetrying:
+        # another worker committed the same product first: run the handler
+        # again against fresh state
+        return retrying(
+            retry=retry_if_exception_type(unit_of_work.ConcurrencyError),
+            stop=stop_after_attempt(self.conflict_attempts),
+            wait=wait_random_exponential(multiplier=0.01, max=1),
+            before_sleep=self._log_conflict,
+            reraise=True,
+        )
+
+    def _log_conflict(self, retry_state) -> None:
+        logger.warning(
+            f"Concurrent update, retrying attempt {retry_state.attempt_number}"
+        )
+        if self.metrics is not None:
+            self.metrics.increment("messagebus_conflict_retries_total")
+
+    def _call(self, handler: Callable, message: Message) -> Any:
+        started = time.perf_counter()
+        try:
+            result = handler(message)
+        except Exception:
+            self._observe(handler, message, started, failed=True)
+            raise
+        self._observe(handler, message, started)
+        return result
+
+    def _observe(
+        self,
+        handler: Callable,
+        message: Message,
+        started: float,
+        failed: bool = False,
+    ) -> None:
+        if self.metrics is None:
+            return
+        labels = self._labels(handler, message)
+        self.metrics.observe(
+            "messagebus_handler_seconds", time.perf_counter() - started, labels
+        )
+        if failed:
+            self.metrics.increment("messagebus_handler_errors_total", labels)
+
+    def _labels(self, handler: Callable, message: Message) -> Labels:
+        key = (type(message), handler)
+        try:
+            return self._label_cache[key]
+        except KeyError:
+            labels = (
+                ("handler", handler_name(handler)),
+                ("message", type(message).__name__),
+            )
+            self._label_cache[key] = labels
+            return labels
+
+    def _dispatch_in_background(
+        self, handler: Callable, event: events.Event
+    ) -> bool:
+        if self.dispatcher is None or not is_fire_and_forget(handler):
+            return False
+        self.dispatcher.submit(handler, event)
+        return True
+
+    def shutdown(self) -> None:
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+        if self.retries is not None:
+            self.retries.shutdown()
 
-    def handle_command(self, command: commands.Command) -> Any:
+    def replay_dead_letters(self) -> int:
+        handlers = {
+            handler_name(handler): handler
+            for event_handlers in self.event_handlers.values()
+            for handler in event_handlers
+        }
+        replayed = (
+            self.retries.replay(handlers) if self.retries is not None else 0
+        )
+        # replayed handlers may only have filled buffers
+        queue: Deque[Message] = deque()
+        self.flush_buffers(queue)
+        for message in queue:
+            self.handle(message)
+        return replayed
+
+    def handle_command(
+        self, command: commands.Command, queue: Deque[Message]
+    ) -> Any:
         try:
             logger.debug(f"Handling command: {command}")
             handler = self.command_handlers[type(command)]
-            result = handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            for attempt in self._retry_conflicts(Retrying):
+                with attempt:
+                    result = self._call(handler, command)
+            queue.extend(self.uow.collect_new_events())
             return result
         except Exception:
             logger.exception(f"Error handling command: {command}")
             raise
+
+
+class AsyncMessageBus(MessageBus):
+    # sync handlers run on executor threads but share one unit of work, so
+    # only one of them may use it at a time, per event loop
+    _uow_lock: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Lock]] = None
+
+    async def handle(self, message: Message) -> List:  # type: ignore
+        results = []
+        queue: Deque[Message] = deque([message])
+        depth_labels = (("message", type(message).__name__),)
+        peak_depth = 1
+        try:
+            while queue:
+                peak_depth = max(peak_depth, len(queue))
+                message = queue.popleft()
+                result = await self.route(message)(message, queue)
+                if isinstance(message, commands.Command):
+                    results.append(result)
+
+                if not queue:
+                    await self.flush_buffers(queue)
+        finally:
+            if self.metrics is not None:
+                self.metrics.gauge(
+                    "messagebus_queue_depth", peak_depth, depth_labels
+                )
+
+        return results
+
+    async def handle_event(  # type: ignore
+        self, event: events.Event, queue: Deque[Message]
+    ) -> None:
+        logger.debug(f"Handling event: {event}")
+        handlers = [
+            handler
+            for handler in self.event_handlers[type(event)]
+            if not self._dispatch_in_background(handler, event)
+        ]
+        outcomes = await asyncio.gather(
+            *(
+                self._call_and_collect(handler, event, queue)
+                for handler in handlers
+            ),
+            return_exceptions=True,
+        )
+        for handler, outcome in zip(handlers, outcomes):
+            if isinstance(outcome, Exception):
+                logger.error(f"Error handling event: {event}: {outcome!r}")
+                self._schedule_retry(handler, event, outcome)
+
+    async def handle_command(  # type: ignore
+        self, command: commands.Command, queue: Deque[Message]
+    ) -> Any:
+        try:
+            logger.debug(f"Handling command: {command}")
+            handler = self.command_handlers[type(command)]
+            async for attempt in self._retry_conflicts(AsyncRetrying):
+                with attempt:
+                    result = await self._call_and_collect(
+                        handler, command, queue
+                    )
+            return result
+        except Exception:
+            logger.exception(f"Error handling command: {command}")
+            raise
+
+    async def flush_buffers(  # type: ignore
+        self, queue: Deque[Message]
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        async with self._lock():
+            await loop.run_in_executor(None, super().flush_buffers, queue)
+
+    async def _call_and_collect(
+        self, handler: Callable, message: Message, queue: Deque[Message]
+    ) -> Any:
+        if inspect.iscoroutinefunction(handler):
+            result = await self._call(handler, message)
+            async with self._lock():
+                queue.extend(self.uow.collect_new_events())
+            return result
+        async with self._lock():
+            sizes = [len(buffer) for buffer in self.buffers]
+            result = await self._call(handler, message)
+            if isinstance(message, events.Event):
+                self._record_buffered(handler, message, sizes)
+            queue.extend(self.uow.collect_new_events())
+        return result
+
+    def _lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._uow_lock is None or self._uow_lock[0] is not loop:
+            self._uow_lock = (loop, asyncio.Lock())
+        return self._uow_lock[1]
+
+    async def _call(  # type: ignore
+        self, handler: Callable, message: Message
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            result = await self._run(handler, message)
+        except Exception:
+            self._observe(handler, message, started, failed=True)
+            raise
+        self._observe(handler, message, started)
+        return result
+
+    @staticmethod
+    async def _run(handler: Callable, message: Message) -> Any:
+        if inspect.iscoroutinefunction(handler):
+            return await handler(message)
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, handler, message)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
@@ -0,0 +1,72 @@
+import abc
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, List, Tuple
+
+from allocation.service_layer import unit_of_work
+
+INSERT_ALLOCATION = (
+    "INSERT INTO allocations_view (orderid, sku, qty, batchref)"
+    " VALUES (:orderid, :sku, :qty, :batchref)"
+)
+DELETE_ALLOCATION = (
+    "DELETE FROM allocations_view WHERE orderid = :orderid AND sku = :sku"
+)
+
+
+class AbstractReadModel(abc.ABC):
+    def __init__(self):
+        self._pending: List[Tuple[str, Dict]] = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add_allocation(
+        self, orderid: str, sku: str, qty: int, batchref: str
+    ) -> None:
+        self._pending.append(
+            (
+                INSERT_ALLOCATION,
+                dict(orderid=orderid, sku=sku, qty=qty, batchref=batchref),
+            )
+        )
+
+    def remove_allocation(self, orderid: str, sku: str) -> None:
+        self._pending.append(
+            (DELETE_ALLOCATION, dict(orderid=orderid, sku=sku))
+        )
+
+    def flush(self) -> None:
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            self._write(
+                [
+                    (statement, [params for _, params in run])
+                    for statement, run in groupby(pending, key=itemgetter(0))
+                ]
+            )
+        except Exception:
+            # keep the rows, in order, ahead of anything added since
+            self._pending = pending + self._pending
+            raise
+
+    def clear(self) -> None:
+        self._pending = []
+
+    @abc.abstractmethod
+    def _write(self, statements: List[Tuple[str, List[Dict]]]) -> None:
+        raise NotImplementedError
+
+
+class SqlAlchemyReadModel(AbstractReadModel):
+    def __init__(self, uow: unit_of_work.SqlAlchemyUnitOfWork):
+        super().__init__()
+        self.uow = uow
+
+    def _write(self, statements: List[Tuple[str, List[Dict]]]) -> None:
+        with self.uow:
+            for statement, params in statements:
+                self.uow.session.execute(statement, params)
+            self.uow.commit()
@@ -0,0 +1,41 @@
+import logging
+from typing import Dict, List
+
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+class Reallocations:
+    def __init__(self, uow: unit_of_work.AbstractUnitOfWork):
+        self.uow = uow
+        self._pending: Dict[str, List[model.OrderLine]] = {}
+
+    def __len__(self):
+        return sum(len(lines) for lines in self._pending.values())
+
+    def add(self, line: model.OrderLine) -> None:
+        self._pending.setdefault(line.sku, []).append(line)
+
+    def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        try:
+            with self.uow:
+                for sku, lines in pending.items():
+                    product = self.uow.products.get(sku=sku)
+                    if product is None:
+                        logger.error(
+                            f"Cannot reallocate lines of unknown sku {sku}"
+                        )
+                        continue
+                    product.allocate_many(lines)
+                self.uow.commit()
+        except Exception:
+            # keep the lines so the bus can retry against fresh state
+            for sku, lines in pending.items():
+                self._pending[sku] = lines + self._pending.get(sku, [])
+            raise
+
+    def clear(self) -> None:
+        self._pending = {}
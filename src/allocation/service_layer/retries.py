@@ -0,0 +1,147 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from allocation.adapters.dead_letters import AbstractDeadLetterStore
+from allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+Retry = Tuple[float, int, Callable, events.Event, int]
+
+
+def handler_name(handler: Callable) -> str:
+    return getattr(handler, "__name__", repr(handler))
+
+
+class RetryScheduler:
+    def __init__(
+        self,
+        dead_letters: AbstractDeadLetterStore,
+        max_attempts: int = 3,
+        backoff: float = 2.0,
+        max_backoff: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+        background: bool = True,
+    ):
+        self.dead_letters = dead_letters
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.background = background
+        self.failures: Counter[str] = Counter()
+        self._queue: List[Retry] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._queue)
+
+    def schedule(
+        self,
+        handler: Callable,
+        event: events.Event,
+        attempt: int = 1,
+        error: str = "",
+    ) -> None:
+        self.failures[handler_name(handler)] += 1
+        if attempt >= self.max_attempts:
+            self.dead_letter(handler, event, error)
+            return
+
+        retry = (
+            self.clock() + self.delay(attempt),
+            next(self._sequence),
+            handler,
+            event,
+            attempt + 1,
+        )
+        with self._condition:
+            heapq.heappush(self._queue, retry)
+            self._condition.notify()
+        if self.background:
+            self._start_worker()
+
+    def run_pending(self) -> None:
+        while True:
+            with self._condition:
+                if not self._queue or self._queue[0][0] > self.clock():
+                    return
+                _, _, handler, event, attempt = heapq.heappop(self._queue)
+            self._run(handler, event, attempt)
+
+    def replay(self, handlers: Dict[str, Callable]) -> int:
+        replayed = 0
+        for dead_letter_id, name, event in self.dead_letters.list():
+            handler = handlers.get(name)
+            if handler is None:
+                logger.error(f"No handler {name} to replay {event}")
+                continue
+            try:
+                handler(event)
+            except Exception:
+                logger.exception(f"Error replaying {name} for {event}")
+                continue
+            self.dead_letters.remove(dead_letter_id)
+            replayed += 1
+        return replayed
+
+    def shutdown(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._worker is not None:
+            self._worker.join()
+
+    def _run(self, handler: Callable, event: events.Event, attempt: int):
+        try:
+            logger.debug(f"Retrying {handler_name(handler)} for {event}")
+            handler(event)
+        except Exception as e:
+            logger.exception(f"Retry {attempt} failed for event: {event}")
+            self.schedule(handler, event, attempt, error=repr(e))
+
+    def delay(self, attempt: int) -> float:
+        return min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+
+    def dead_letter(
+        self, handler: Callable, event: events.Event, error: str
+    ) -> None:
+        logger.error(f"Giving up on {handler_name(handler)} for {event}")
+        try:
+            self.dead_letters.add(handler_name(handler), event, error)
+        except Exception:
+            logger.exception(f"Could not store dead letter for {event}")
+
+    def _start_worker(self) -> None:
+        with self._condition:
+            if self._worker is not None or self._stopped:
+                return
+            self._worker = threading.Thread(
+                target=self._work, name="retry-scheduler", daemon=True
+            )
+        self._worker.start()
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped and not self._due():
+                    self._condition.wait(timeout=self._next_delay())
+                if self._stopped:
+                    return
+            self.run_pending()
+
+    def _due(self) -> bool:
+        return bool(self._queue) and self._queue[0][0] <= self.clock()
+
+    def _next_delay(self) -> Optional[float]:
+        if not self._queue:
+            return None
+        return max(self._queue[0][0] - self.clock(), 0)
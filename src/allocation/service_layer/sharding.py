@@ -0,0 +1,198 @@
+import itertools
+import multiprocessing
+import pickle
+import threading
+import zlib
+from collections import defaultdict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+
+
+class ShardUnavailable(Exception):
+    pass
+
+
+def shard_for_sku(sku: model.Sku, shards: int) -> int:
+    # crc32 rather than hash(): it must agree across processes
+    return zlib.crc32(sku.encode()) % shards
+
+
+def _run_shard(bus_factory: Callable, inbox, results) -> None:
+    bus = bus_factory()
+    try:
+        for request_id, message in iter(inbox.get, None):
+            try:
+                result = bus.handle(message)
+                # fail here rather than in the queue's feeder thread, where
+                # the caller would never hear about it
+                pickle.dumps(result)
+                results.put((request_id, result, None))
+            except Exception as e:
+                try:
+                    pickle.dumps(e)
+                except Exception:
+                    e = RuntimeError(repr(e))
+                results.put((request_id, None, e))
+    finally:
+        bus.shutdown()
+
+
+class ShardedMessageBus:
+    def __init__(
+        self,
+        bus_factory: Callable,
+        shards: int,
+        uow: unit_of_work.AbstractUnitOfWork,
+        context: Optional[str] = "spawn",
+        timeout: float = 30,
+    ) -> None:
+        self.shards = shards
+        self.uow = uow
+        self.timeout = timeout
+        self.batch_skus: Dict[model.Reference, model.Sku] = {}
+        self._futures: Dict[int, Tuple[int, Future]] = {}
+        self._request_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._bus_factory = bus_factory
+
+        self._mp = multiprocessing.get_context(context)
+        self._results = self._mp.Queue()
+        self._inboxes = [self._mp.Queue() for _ in range(shards)]
+        self._workers = [self._start_worker(shard) for shard in range(shards)]
+        self._collector = threading.Thread(
+            target=self._collect_results, name="shard-results", daemon=True
+        )
+        self._collector.start()
+        self._monitor = threading.Thread(
+            target=self._watch_workers, name="shard-monitor", daemon=True
+        )
+        self._monitor.start()
+
+    def shard_for(self, message: commands.Command) -> int:
+        if isinstance(message, commands.ChangeBatchQuantity):
+            sku = self.sku_for_batch(message.reference)
+            return shard_for_sku(sku, self.shards) if sku else 0
+        if isinstance(message, commands.CreateBatch):
+            self.batch_skus[message.reference] = message.sku
+        try:
+            return shard_for_sku(message.sku, self.shards)  # type: ignore
+        except AttributeError:
+            raise TypeError(f"Cannot route message type {type(message)}")
+
+    def sku_for_batch(self, reference: model.Reference) -> Optional[model.Sku]:
+        if reference not in self.batch_skus:
+            with self.uow:
+                product = self.uow.products.get_by_batch_reference(reference)
+                if product is None:
+                    return None
+                self.batch_skus[reference] = product.sku
+        return self.batch_skus[reference]
+
+    def submit(self, message: commands.Command) -> Future:
+        return self._submit(self.shard_for(message), message)
+
+    def handle(self, message: commands.Command) -> List:
+        if isinstance(message, commands.AllocateMany):
+            return [self._allocate_many(message)]
+        shard = self.shard_for(message)
+        return self._wait(shard, self._submit(shard, message))
+
+    def shutdown(self) -> None:
+        self._closing.set()
+        self._monitor.join()
+        with self._lock:
+            for inbox in self._inboxes:
+                inbox.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        self._collector.join()
+
+    def _allocate_many(self, message: commands.AllocateMany) -> List[Any]:
+        positions = defaultdict(list)  # type: Dict[int, List[int]]
+        for position, line in enumerate(message.lines):
+            positions[shard_for_sku(line.sku, self.shards)].append(position)
+
+        futures = {
+            shard: self._submit(
+                shard,
+                commands.AllocateMany([message.lines[i] for i in indexes]),
+            )
+            for shard, indexes in positions.items()
+        }
+        batchrefs = [None] * len(message.lines)  # type: List[Any]
+        for shard, future in futures.items():
+            [shard_batchrefs] = self._wait(shard, future)
+            for position, batchref in zip(positions[shard], shard_batchrefs):
+                batchrefs[position] = batchref
+        return batchrefs
+
+    def _submit(self, shard: int, message: commands.Command) -> Future:
+        future: Future = Future()
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._futures[request_id] = (shard, future)
+            self._inboxes[shard].put((request_id, message))
+        return future
+
+    def _wait(self, shard: int, future: Future) -> Any:
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            raise ShardUnavailable(
+                f"Shard {shard} did not answer within {self.timeout}s"
+            )
+
+    def _start_worker(self, shard: int) -> multiprocessing.Process:
+        worker = self._mp.Process(
+            target=_run_shard,
+            args=(self._bus_factory, self._inboxes[shard], self._results),
+            name=f"allocation-shard-{shard}",
+            daemon=True,
+        )
+        worker.start()
+        return worker
+
+    def _watch_workers(self) -> None:
+        while not self._closing.is_set():
+            sentinels = {w.sentinel: s for s, w in enumerate(self._workers)}
+            for sentinel in wait(list(sentinels), timeout=0.1):
+                if not self._closing.is_set():
+                    self._restart(sentinels[sentinel])
+
+    def _restart(self, shard: int) -> None:
+        worker = self._workers[shard]
+        worker.join()
+        error = ShardUnavailable(
+            f"Shard {shard} exited with code {worker.exitcode}"
+        )
+        with self._lock:
+            # whatever the dead worker had queued or in hand is lost with it
+            lost = [
+                request_id
+                for request_id, (owner, _) in self._futures.items()
+                if owner == shard
+            ]
+            failed = [self._futures.pop(request_id)[1] for request_id in lost]
+            self._inboxes[shard] = self._mp.Queue()
+            self._workers[shard] = self._start_worker(shard)
+        for future in failed:
+            future.set_exception(error)
+
+    def _collect_results(self) -> None:
+        for request_id, result, error in iter(self._results.get, None):
+            with self._lock:
+                # requests of a crashed shard have already been failed
+                _, future = self._futures.pop(request_id, (None, None))
+            if future is None:
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
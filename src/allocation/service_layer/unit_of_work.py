@@ -1,22 +1,36 @@
 import abc
-from typing import Generator, Optional
+from typing import Generator, List, Optional, Set
 
 from allocation import config
-from allocation.adapters import repository
-from allocation.domain import events
+from allocation.adapters import outbox, repository
+from allocation.domain import events, model
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 
 DEFAULT_SESSION_FACTORY = sessionmaker(
     bind=create_engine(config.get_postgres_uri())
 )
+DEFAULT_PRODUCT_CACHE = (
+    repository.ProductCache(config.get_product_cache_size())
+    if config.get_product_cache_size()
+    else None
+)
+
+
+class ConcurrencyError(Exception):
+    pass
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
 
+    def __init__(self):
+        # events raised outside any aggregate, e.g. by SQL fast paths
+        self.events: List[events.Event] = []
+
     def __enter__(self):
-        pass
+        self.events = []
 
     def __exit__(self, *args):
         self.rollback()
@@ -40,26 +54,78 @@ class AbstractUnitOfWork(abc.ABC):
     ) -> Optional[Generator[events.Event, None, None]]:
         for product in self.products.seen:
             while product.events:
-                yield product.events.pop(0)
+                new_events, product.events = product.events, []
+                yield from new_events
+        while self.events:
+            new_events, self.events = self.events, []
+            yield from new_events
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        cache: Optional[repository.ProductCache] = DEFAULT_PRODUCT_CACHE,
+    ):
+        super().__init__()
         self.session_factory = session_factory
+        self.cache = cache
+        self._releasable: List[model.Product] = []
 
     def __enter__(self):
+        self._release_to_cache()
         self.session = self.session_factory()
-        self.products = repository.TrackingRepository(
-            repository.SqlAlchemyRepository(self.session)
-        )
+        repo = repository.SqlAlchemyRepository(self.session)
+        self._cached: Optional[repository.CachingRepository] = None
+        if self.cache is not None:
+            self._cached = repository.CachingRepository(repo, self.cache)
+            # cached products must keep their state past the commit
+            self.session.expire_on_commit = False
+            repo = self._cached
+        self.products = repository.TrackingRepository(repo)
+        self._outboxed: Set[int] = set()
         return super().__enter__()
 
     def __exit__(self, *args):
+        if self._cached is not None:
+            self._releasable = self._cached.releasable()
+            # rollback would expire everything still in the session
+            self.session.expunge_all()
         super().__exit__(*args)
         self.session.close()
 
     def _commit(self):
-        self.session.commit()
+        pending = [product.events for product in self.products.seen]
+        pending.append(self.events)
+        new_events = [
+            event
+            for raised in pending
+            for event in raised
+            if id(event) not in self._outboxed
+        ]
+        outbox.add(self.session, new_events)
+        self._outboxed.update(id(event) for event in new_events)
+        try:
+            self.session.commit()
+        except StaleDataError as e:
+            self.session.rollback()
+            raise ConcurrencyError(str(e)) from e
+        if self._cached is not None:
+            self._cached.committed(self.products.seen)
 
     def _rollback(self):
         self.session.rollback()
+
+    def collect_new_events(
+        self,
+    ) -> Optional[Generator[events.Event, None, None]]:
+        yield from super().collect_new_events()
+        # hand products back only once their events are out, the next
+        # unit of work to check one out starts a fresh event list
+        self._release_to_cache()
+
+    def _release_to_cache(self) -> None:
+        if self.cache is not None:
+            for product in self._releasable:
+                self.cache.put(product)
+        self._releasable = []
@@ -1,5 +1,5 @@
 from allocation.service_layer import unit_of_work
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 
 def allocations(
@@ -19,3 +19,79 @@ def allocations(
         {"sku": sku, "batchref": batchref, "qty": qty}
         for sku, qty, batchref in results
     ]
+
+
+def batch_history(
+    reference: str, uow: unit_of_work.SqlAlchemyUnitOfWork
+) -> Optional[Dict]:
+    with uow:
+        # a live batch wins over archived ones that shared its reference,
+        # then the latest archived one
+        batches = list(
+            uow.session.execute(
+                "SELECT id, sku, _purchased_quantity, eta, 0 AS archived"
+                " FROM batches WHERE reference = :reference"
+                " UNION ALL"
+                " SELECT id, sku, _purchased_quantity, eta, 1 AS archived"
+                " FROM archived_batches WHERE reference = :reference"
+                " ORDER BY archived, id DESC",
+                {"reference": reference},
+            )
+        )
+        if not batches:
+            return None
+        batch_id, sku, qty, eta, archived = batches[0]
+        if archived:
+            lines = uow.session.execute(
+                "SELECT orderid, qty FROM archived_allocations"
+                " WHERE batch_id = :batch_id ORDER BY id",
+                {"batch_id": batch_id},
+            )
+        else:
+            lines = uow.session.execute(
+                "SELECT order_lines.orderid, order_lines.qty"
+                " FROM allocations"
+                " JOIN order_lines ON order_lines.id = allocations.orderline_id"
+                " WHERE allocations.batch_id = :batch_id"
+                " ORDER BY order_lines.id",
+                {"batch_id": batch_id},
+            )
+        allocations = [
+            {"orderid": orderid, "qty": qty} for orderid, qty in lines
+        ]
+
+    return {
+        "reference": reference,
+        "sku": sku,
+        "qty": qty,
+        "eta": str(eta) if eta else None,
+        "archived": bool(archived),
+        "allocations": allocations,
+    }
+
+
+def product_history(
+    sku: str, uow: unit_of_work.SqlAlchemyUnitOfWork
+) -> List[Dict]:
+    with uow:
+        results = list(
+            uow.session.execute(
+                "SELECT reference, _purchased_quantity, eta, 0 AS archived"
+                " FROM batches WHERE sku = :sku"
+                " UNION ALL"
+                " SELECT reference, _purchased_quantity, eta, 1 AS archived"
+                " FROM archived_batches WHERE sku = :sku"
+                " ORDER BY archived DESC, eta, reference",
+                {"sku": sku},
+            )
+        )
+
+    return [
+        {
+            "reference": reference,
+            "qty": qty,
+            "eta": str(eta) if eta else None,
+            "archived": bool(archived),
+        }
+        for reference, qty, eta, archived in results
+    ]
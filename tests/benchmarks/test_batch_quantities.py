@@ -0,0 +1,28 @@
+import timeit
+
+import pytest
+from allocation.domain.model import Batch, OrderLine
+
+pytestmark = pytest.mark.benchmark
+
+
+def make_batch_with_allocations(count):
+    batch = Batch("batch-001", "SKU", qty=count * 2, eta=None)
+    for i in range(count):
+        batch.allocate(OrderLine(f"order-{i}", "SKU", 1))
+    return batch
+
+
+def time_available_quantity(batch, number=10_000):
+    return timeit.timeit(lambda: batch.available_quantity, number=number)
+
+
+def test_available_quantity_reads_do_not_grow_with_allocations():
+    timings = {}
+    for count in (10, 1_000, 10_000):
+        batch = make_batch_with_allocations(count)
+        timings[count] = time_available_quantity(batch)
+        print(f"{count:>6} allocations: {timings[count] * 100:.3f} us/read")
+
+    assert batch.has_consistent_allocated_quantity()
+    assert timings[10_000] < timings[10] * 10
@@ -0,0 +1,65 @@
+import time
+from datetime import date, timedelta
+
+import pytest
+from allocation.domain.model import Batch, OrderLine, Product
+
+pytestmark = pytest.mark.benchmark
+
+today = date.today()
+
+
+def make_product(batch_count=5_000, qty=100):
+    return Product(
+        "LAMP",
+        [
+            Batch(f"batch-{i}", "LAMP", qty, today + timedelta(days=i))
+            for i in range(batch_count)
+        ],
+    )
+
+
+def make_lines(count=5_000):
+    return [
+        OrderLine(f"order-{i}", "LAMP", 30 + (i * 37) % 41)
+        for i in range(count)
+    ]
+
+
+def test_allocate_many_against_repeated_allocate():
+    lines = make_lines()
+
+    product = make_product()
+    start = time.perf_counter()
+    expected = [product.allocate(line) for line in lines]
+    one_by_one = time.perf_counter() - start
+
+    product = make_product()
+    start = time.perf_counter()
+    references = product.allocate_many(lines)
+    in_bulk = time.perf_counter() - start
+
+    print(f"allocate x{len(lines)}: {one_by_one:.3f}s")
+    print(f"allocate_many: {in_bulk:.3f}s")
+    assert references == expected
+
+
+def test_rebalance_of_a_large_sku():
+    product = make_product(batch_count=2_000, qty=5_000)
+    product.allocate_many(make_lines(count=100_000))
+    for line in list(product.batches_by_line)[::3]:
+        product.deallocate(line)
+    etas = {line: batch.eta for line, batch in product.batches_by_line.items()}
+
+    start = time.perf_counter()
+    moved = product.rebalance()
+    elapsed = time.perf_counter() - start
+
+    print(f"rebalance of {len(product.batches_by_line)} lines: {elapsed:.3f}s")
+    print(f"moved {moved} lines")
+    assert all(b.has_consistent_allocated_quantity() for b in product.batches)
+    assert all(
+        batch.eta <= etas[line]
+        for line, batch in product.batches_by_line.items()
+    )
+    assert elapsed < 10
@@ -0,0 +1,163 @@
+import random
+import statistics
+import time
+
+import pytest
+from allocation import views
+from allocation.adapters import migrations
+from allocation.adapters.orm import (
+    allocations,
+    allocations_view,
+    batches,
+    order_lines,
+    products,
+)
+from allocation.service_layer import read_model, unit_of_work
+
+pytestmark = pytest.mark.benchmark
+
+SKUS = 25_000
+BATCHES_PER_SKU = 10
+ROWS_PER_TABLE = SKUS * BATCHES_PER_SKU
+CHUNK = 50_000
+LOOKUPS = 20
+
+
+def seed(engine):
+    # 25k products plus 250k rows in each of the four hot tables
+    with engine.begin() as connection:
+        connection.execute(
+            products.insert(), [dict(sku=f"sku{i}") for i in range(SKUS)]
+        )
+        for start in range(0, ROWS_PER_TABLE, CHUNK):
+            ids = range(start + 1, start + CHUNK + 1)
+            connection.execute(
+                batches.insert(),
+                [
+                    dict(
+                        id=i,
+                        reference=f"batch{i}",
+                        sku=f"sku{i % SKUS}",
+                        _purchased_quantity=100,
+                    )
+                    for i in ids
+                ],
+            )
+            connection.execute(
+                order_lines.insert(),
+                [
+                    dict(id=i, orderid=f"order{i}", sku=f"sku{i % SKUS}", qty=1)
+                    for i in ids
+                ],
+            )
+            connection.execute(
+                allocations.insert(),
+                [dict(orderline_id=i, batch_id=i) for i in ids],
+            )
+            connection.execute(
+                allocations_view.insert(),
+                [
+                    dict(
+                        orderid=f"order{i}",
+                        sku=f"sku{i % SKUS}",
+                        qty=1,
+                        batchref=f"batch{i}",
+                    )
+                    for i in ids
+                ],
+            )
+
+
+def query_paths(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=None)
+
+    # the repository's statements as raw SQL: migrating down to version 0
+    # drops columns the mappers select
+    def load_product(session, sku):
+        session.execute(
+            "SELECT sku FROM products WHERE sku = :sku",
+            dict(sku=sku),
+        ).fetchall()
+        batch_ids = [
+            str(batch_id)
+            for [batch_id] in session.execute(
+                "SELECT id FROM batches WHERE sku = :sku", dict(sku=sku)
+            )
+        ]
+        session.execute(
+            "SELECT order_lines.id FROM allocations JOIN order_lines"
+            " ON order_lines.id = allocations.orderline_id"
+            f" WHERE allocations.batch_id IN ({', '.join(batch_ids)})"
+        ).fetchall()
+
+    def get(i):
+        session = session_factory()
+        load_product(session, f"sku{i % SKUS}")
+        session.close()
+
+    def get_by_batch_reference(i):
+        session = session_factory()
+        [[sku]] = session.execute(
+            "SELECT sku FROM batches WHERE reference = :reference LIMIT 1",
+            dict(reference=f"batch{i}"),
+        )
+        load_product(session, sku)
+        session.close()
+
+    def order_line(i):
+        session = session_factory()
+        session.execute(
+            "SELECT id FROM order_lines"
+            " WHERE orderid = :orderid AND sku = :sku",
+            dict(orderid=f"order{i}", sku=f"sku{i % SKUS}"),
+        ).fetchall()
+        session.close()
+
+    def allocations_view(i):
+        views.allocations(f"order{i}", uow)
+
+    def read_model_delete(i):
+        session = session_factory()
+        session.execute(
+            read_model.DELETE_ALLOCATION,
+            dict(orderid=f"order{i}", sku=f"sku{i % SKUS}"),
+        )
+        session.rollback()
+        session.close()
+
+    return dict(
+        get=get,
+        get_by_batch_reference=get_by_batch_reference,
+        order_line=order_line,
+        allocations_view=allocations_view,
+        read_model_delete=read_model_delete,
+    )
+
+
+def median_latency(lookup):
+    keys = random.Random(42).sample(range(1, ROWS_PER_TABLE + 1), LOOKUPS)
+    timings = []
+    for key in keys:
+        start = time.perf_counter()
+        lookup(key)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def test_lookup_latency_before_and_after_migrating(
+    in_memory_db, session_factory
+):
+    seed(in_memory_db)
+    paths = query_paths(session_factory)
+
+    migrations.migrate(in_memory_db, target=0)
+    before = {name: median_latency(path) for name, path in paths.items()}
+    migrations.migrate(in_memory_db)
+    after = {name: median_latency(path) for name, path in paths.items()}
+
+    for name in paths:
+        print(
+            f"{name}: {before[name] * 1000:.2f}ms unindexed,"
+            f" {after[name] * 1000:.2f}ms indexed"
+        )
+    assert all(after[name] < before[name] for name in paths)
@@ -0,0 +1,84 @@
+import tracemalloc
+from dataclasses import dataclass
+
+import pytest
+from allocation.adapters import orm
+from allocation.domain import events, model
+from sqlalchemy import event
+
+pytestmark = pytest.mark.benchmark
+
+ALLOCATIONS = 20_000
+
+
+@dataclass
+class DictAllocated:
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+def bytes_per_instance(factory, count=ALLOCATIONS):
+    tracemalloc.start()
+    instances = [factory(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(instances) == count
+    return size / count
+
+
+def seed_allocations(session, count=ALLOCATIONS):
+    session.execute("INSERT INTO products (sku) VALUES ('LAMP')")
+    session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity)"
+        " VALUES ('batch1', 'LAMP', :qty)",
+        dict(qty=count),
+    )
+    session.execute(
+        "INSERT INTO order_lines (orderid, sku, qty) VALUES"
+        " (:orderid, :sku, 1)",
+        [dict(orderid=f"order{i}", sku="LAMP") for i in range(count)],
+    )
+    session.execute(
+        "INSERT INTO allocations (orderline_id, batch_id)"
+        " SELECT id, (SELECT id FROM batches) FROM order_lines"
+    )
+    session.commit()
+
+
+def bytes_per_loaded_allocation(session_factory, count=ALLOCATIONS):
+    session = session_factory()
+    tracemalloc.start()
+    [batch] = session.query(model.Batch).all()
+    assert len(batch._allocations) == count
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    session.close()
+    return size / count
+
+
+def test_slotted_events_are_smaller():
+    with_dict = bytes_per_instance(
+        lambda i: DictAllocated(f"order{i}", "LAMP", i, "batch1")
+    )
+    slotted = bytes_per_instance(
+        lambda i: events.Allocated(f"order{i}", "LAMP", i, "batch1")
+    )
+    print(f"Allocated event: {with_dict:.0f} -> {slotted:.0f} bytes")
+
+    assert slotted < with_dict
+
+
+def test_loaded_allocations_share_sku(session_factory):
+    seed_allocations(session_factory())
+
+    event.remove(model.OrderLine, "load", orm.receive_order_line_load)
+    try:
+        before = bytes_per_loaded_allocation(session_factory)
+    finally:
+        event.listen(model.OrderLine, "load", orm.receive_order_line_load)
+    after = bytes_per_loaded_allocation(session_factory)
+    print(f"loaded allocation: {before:.0f} -> {after:.0f} bytes")
+
+    assert after < before
@@ -0,0 +1,120 @@
+import functools
+import itertools
+import statistics
+import time
+import timeit
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters.metrics import PrometheusMetrics
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+from ..unit.test_handlers import FakeReadModel, FakeUnitOfWork
+
+pytestmark = pytest.mark.benchmark
+
+MESSAGES = 20_000
+
+skus = itertools.count()
+
+
+def inject_with_merged_kwargs(handler, dependencies):
+    params = bootstrap.inspect.signature(handler).parameters
+    deps = {
+        name: dependency
+        for name, dependency in dependencies.items()
+        if name in params
+    }
+
+    @functools.wraps(handler)
+    def injected(*args, **kwargs):
+        return handler(*args, **{**deps, **kwargs})
+
+    return injected
+
+
+def messages_per_second(uow, metrics=None, count=200):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        send_mail=lambda *args, **kwargs: None,
+        read_model=FakeReadModel(),
+        metrics=metrics,
+    )
+    sku = f"LAMP-{next(skus)}"
+    bus.handle(commands.CreateBatch(f"{sku}-batch", sku, count, None))
+    allocations = [commands.Allocate(f"order{i}", sku, 1) for i in range(count)]
+
+    start = time.perf_counter()
+    for allocation in allocations:
+        bus.handle(allocation)
+    elapsed = time.perf_counter() - start
+    bus.shutdown()
+
+    # every allocation also publishes an Allocated event
+    return 2 * count / elapsed
+
+
+def test_injected_handler_calls():
+    def handler(message, uow, send_mail):
+        pass
+
+    dependencies = {"uow": FakeUnitOfWork(), "send_mail": print}
+    merged = inject_with_merged_kwargs(handler, dependencies)
+    precompiled = bootstrap.inject_dependencies(handler, dependencies)
+
+    merged_time = timeit.timeit(lambda: merged(None), number=MESSAGES * 10)
+    precompiled_time = timeit.timeit(
+        lambda: precompiled(None), number=MESSAGES * 10
+    )
+
+    print(f"merged kwargs: {merged_time:.3f}s")
+    print(f"precompiled: {precompiled_time:.3f}s")
+    assert precompiled_time < merged_time
+
+
+def instrumentation_seconds(metrics=None, number=MESSAGES * 10):
+    # what the bus adds around each handler call, and once per cycle, with
+    # a handler that does nothing
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        send_mail=lambda *args, **kwargs: None,
+        read_model=FakeReadModel(),
+        metrics=metrics,
+    )
+    message = commands.Allocate("order1", "LAMP", 1)
+    labels = (("message", "Allocate"),)
+
+    def handler(message):
+        pass
+
+    def cycle():
+        bus._call(handler, message)
+        if bus.metrics is not None:
+            bus.metrics.gauge("messagebus_queue_depth", 1, labels)
+
+    timings = timeit.repeat(cycle, number=number, repeat=7)
+    bus.shutdown()
+    return min(timings) / number
+
+
+def test_metrics_overhead(session_factory):
+    instrumentation = (
+        instrumentation_seconds(PrometheusMetrics()) - instrumentation_seconds()
+    )
+    rates = [
+        messages_per_second(
+            unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+            PrometheusMetrics(),
+        )
+        for _ in range(5)
+    ]
+    # every message costs at most one handler call and one gauge
+    overhead = instrumentation * statistics.median(rates)
+
+    print(f"instrumentation: {instrumentation * 1e6:.1f}us per message")
+    print(f"with metrics: {statistics.median(rates):,.0f} messages/s")
+    print(f"overhead: {overhead:.2%}")
+    assert overhead < 0.02
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+pytestmark = pytest.mark.benchmark
+
+LINES_PER_BATCH = 5
+ALLOCATIONS = 20
+
+
+def make_sku_with_history(session_factory, sku, history):
+    # `history` fully allocated batches and one with plenty of room
+    batches = [
+        model.Batch(f"{sku}-old{i}", sku, LINES_PER_BATCH, None)
+        for i in range(history)
+    ]
+    for i, batch in enumerate(batches):
+        for j in range(LINES_PER_BATCH):
+            batch.allocate(model.OrderLine(f"old-{i}-{j}", sku, 1))
+    batches.append(model.Batch(f"{sku}-current", sku, 1_000_000, None))
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=None)
+    with uow:
+        uow.products.add(model.Product(sku, batches))
+        uow.commit()
+
+
+def allocate_fully_loaded(message, uow):
+    with uow:
+        product = uow.products.get(sku=message.sku)
+        batchref = product.allocate(
+            model.OrderLine(message.orderid, message.sku, message.qty)
+        )
+        uow.commit()
+    return batchref
+
+
+def seconds_per_allocation(session_factory, sku, allocate):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=None)
+    start = time.perf_counter()
+    for i in range(ALLOCATIONS):
+        batchref = allocate(commands.Allocate(f"order{i}", sku, 1), uow)
+        assert batchref == f"{sku}-current"
+    return (time.perf_counter() - start) / ALLOCATIONS
+
+
+@pytest.mark.parametrize("history", [100, 2_000])
+def test_allocation_cost_against_sku_history(session_factory, history):
+    make_sku_with_history(session_factory, "FULL", history)
+    make_sku_with_history(session_factory, "PARTIAL", history)
+
+    full = seconds_per_allocation(
+        session_factory, "FULL", allocate_fully_loaded
+    )
+    partial = seconds_per_allocation(
+        session_factory, "PARTIAL", handlers.allocate
+    )
+
+    print(f"{history} old batches, full aggregate: {full * 1000:.2f}ms")
+    print(f"{history} old batches, allocatable only: {partial * 1000:.2f}ms")
+    assert partial < full
@@ -0,0 +1,59 @@
+import time
+
+import pytest
+from allocation.adapters import repository
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.benchmark
+
+BATCHES = 50
+LINES = 2_000
+ALLOCATIONS = 200
+
+
+def make_hot_sku(session_factory, sku):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=None)
+    with uow:
+        product = model.Product(
+            sku,
+            [
+                model.Batch(f"{sku}-batch{i}", sku, 1_000, None)
+                for i in range(BATCHES)
+            ],
+        )
+        product.allocate_many(
+            [model.OrderLine(f"old-order{i}", sku, 1) for i in range(LINES)]
+        )
+        uow.products.add(product)
+        uow.commit()
+
+
+def allocations_per_second(uow, sku):
+    start = time.perf_counter()
+    for i in range(ALLOCATIONS):
+        with uow:
+            product = uow.products.get(sku=sku)
+            product.allocate(model.OrderLine(f"order{i}", sku, 1))
+            uow.commit()
+    return ALLOCATIONS / (time.perf_counter() - start)
+
+
+def test_hot_sku_allocations_with_and_without_the_cache(session_factory):
+    make_hot_sku(session_factory, "UNCACHED")
+    make_hot_sku(session_factory, "CACHED")
+
+    uncached = allocations_per_second(
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=None),
+        "UNCACHED",
+    )
+    cached = allocations_per_second(
+        unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory, cache=repository.ProductCache()
+        ),
+        "CACHED",
+    )
+
+    print(f"uncached: {uncached:,.0f} allocations/s")
+    print(f"cached: {cached:,.0f} allocations/s")
+    assert cached > uncached
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, unit_of_work
+from sqlalchemy import event
+
+pytestmark = pytest.mark.benchmark
+
+LINES = 1_000
+
+
+def make_messagebus(session_factory):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        send_mail=lambda *args, **kwargs: None,
+    )
+
+
+def reallocate_one_by_one(messagebus):
+    def reallocate(message):
+        handlers.allocate(
+            commands.Allocate(message.orderid, message.sku, message.qty),
+            messagebus.uow,
+        )
+
+    messagebus.event_handlers[events.Deallocated][0] = reallocate
+
+
+def evict_lines(session_factory, messagebus):
+    messagebus.handle(commands.CreateBatch("batch1", "LAMP", LINES, None))
+    messagebus.handle(commands.CreateBatch("batch2", "LAMP", LINES, None))
+    messagebus.handle(
+        commands.AllocateMany(
+            [commands.Allocate(f"order{i}", "LAMP", 1) for i in range(LINES)]
+        )
+    )
+
+    commits = []
+    listener = lambda session: commits.append(session)  # noqa: E731
+    event.listen(session_factory, "after_commit", listener)
+    start = time.perf_counter()
+    messagebus.handle(commands.ChangeBatchQuantity("batch1", 0))
+    elapsed = time.perf_counter() - start
+    event.remove(session_factory, "after_commit", listener)
+    return len(commits), elapsed
+
+
+def test_reallocating_an_eviction_one_line_at_a_time(session_factory):
+    messagebus = make_messagebus(session_factory)
+    reallocate_one_by_one(messagebus)
+
+    transactions, elapsed = evict_lines(session_factory, messagebus)
+
+    print(f"one by one: {transactions} transactions, {elapsed:.3f}s")
+    assert transactions > LINES
+
+
+def test_reallocating_an_eviction_in_bulk(session_factory):
+    messagebus = make_messagebus(session_factory)
+
+    transactions, elapsed = evict_lines(session_factory, messagebus)
+
+    print(f"in bulk: {transactions} transactions, {elapsed:.3f}s")
+    assert transactions == 3
@@ -6,7 +6,8 @@ from pathlib import Path
 import pytest
 import requests
 from allocation import config
-from allocation.adapters.orm import metadata, start_mappers
+from allocation.adapters import migrations
+from allocation.adapters.orm import start_mappers
 from redis import Redis
 from requests.exceptions import ConnectionError
 from sqlalchemy import create_engine
@@ -22,7 +23,7 @@ def url():
 @pytest.fixture
 def in_memory_db():
     engine = create_engine("sqlite:///:memory:")
-    metadata.create_all(engine)
+    migrations.migrate(engine)
     return engine
 
 
@@ -63,7 +64,7 @@ def wait_for_webapp_to_come_up():
 def postgres_db():
     engine = create_engine(config.get_postgres_uri())
     wait_for_postgres_to_come_up(engine)
-    metadata.create_all(engine)
+    migrations.migrate(engine)
     return engine
 
 
@@ -176,3 +177,17 @@ def random_orderid(random_suffix):
         return f"order-{name}-{random_suffix()}"
 
     return _random_orderid
+
+
+@pytest.fixture
+def post_to_allocate_many(url):
+    def _allocate_many(lines, ndjson=False):
+        if ndjson:
+            return requests.post(
+                f"{url}/allocate_many",
+                data="\n".join(json.dumps(line) for line in lines),
+                headers={"Content-Type": "application/x-ndjson"},
+            )
+        return requests.post(f"{url}/allocate_many", json=lines)
+
+    return _allocate_many
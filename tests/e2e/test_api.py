@@ -188,3 +188,91 @@ def test_change_batch_quantity_leading_to_reallocation(
                 data = json.loads(message["data"])
                 assert data["orderid"] == orderid
                 assert data["batchref"] == later_batch
+
+
+@pytest.mark.parametrize("ndjson", [False, True], ids=["json", "ndjson"])
+@pytest.mark.usefixtures("restart_api")
+def test_allocate_many_returns_a_batchref_per_line(
+    post_to_add_batch,
+    post_to_allocate_many,
+    random_sku,
+    random_batchref,
+    random_orderid,
+    ndjson,
+):
+    orderid = random_orderid()
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    post_to_add_batch(batch, sku, 10, None)
+    post_to_add_batch(otherbatch, othersku, 10, None)
+    lines = [
+        {"orderid": orderid, "sku": sku, "qty": 6},
+        {"orderid": orderid, "sku": othersku, "qty": 3},
+        {"orderid": random_orderid(), "sku": sku, "qty": 6},
+    ]
+
+    response = post_to_allocate_many(lines, ndjson=ndjson)
+
+    assert response.status_code == 202, response.text
+    assert [line["batchref"] for line in response.json()["allocations"]] == [
+        batch,
+        otherbatch,
+        None,
+    ]
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_allocate_many_rejects_unknown_skus(post_to_allocate_many, random_sku):
+    response = post_to_allocate_many(
+        [{"orderid": "order1", "sku": random_sku(), "qty": 1}]
+    )
+
+    assert response.status_code == 400
+    assert response.json()["message"].startswith("Invalid sku")
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_metrics_are_exposed_in_prometheus_format(
+    url, post_to_add_batch, random_sku, random_batchref
+):
+    post_to_add_batch(random_batchref(), random_sku(), 100, None)
+
+    response = requests.get(f"{url}/metrics")
+
+    assert response.status_code == 200, response.text
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert "# TYPE messagebus_handler_seconds histogram" in response.text
+    assert 'handler="add_batch",message="CreateBatch"' in response.text
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_batch_and_product_history(
+    url,
+    post_to_add_batch,
+    post_to_allocate,
+    random_sku,
+    random_batchref,
+    random_orderid,
+):
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+    post_to_add_batch(batchref, sku, 10, "2011-01-01")
+    post_to_allocate(orderid, sku, 4)
+
+    response = requests.get(f"{url}/batches/{batchref}/history")
+    assert response.status_code == 200, response.text
+    assert response.json() == {
+        "reference": batchref,
+        "sku": sku,
+        "qty": 10,
+        "eta": "2011-01-01",
+        "archived": False,
+        "allocations": [{"orderid": orderid, "qty": 4}],
+    }
+
+    response = requests.get(f"{url}/products/{sku}/history")
+    assert response.status_code == 200, response.text
+    assert [batch["reference"] for batch in response.json()] == [batchref]
+
+    response = requests.get(f"{url}/batches/{random_batchref()}/history")
+    assert response.status_code == 404
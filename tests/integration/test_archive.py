@@ -0,0 +1,126 @@
+from datetime import date, timedelta
+
+import pytest
+from allocation import bootstrap, views
+from allocation.adapters import repository
+from allocation.adapters.archive import BatchArchiver
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+today = date.today()
+last_week = today - timedelta(days=7)
+yesterday = today - timedelta(days=1)
+tomorrow = today + timedelta(days=1)
+
+
+@pytest.fixture
+def messagebus(session_factory):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=None),
+        send_mail=lambda *args, **kwargs: None,
+    )
+
+
+def make_history(messagebus):
+    for reference, qty, eta in [
+        ("delivered1", 5, last_week),
+        ("delivered2", 5, yesterday),
+        ("delivered-with-room", 100, yesterday),
+        ("in-stock", 5, None),
+        ("shipment", 5, tomorrow),
+    ]:
+        messagebus.handle(commands.CreateBatch(reference, "LAMP", qty, eta))
+    # stock goes first, then by ETA: order2 and order3 fill delivered1,
+    # order4 fills delivered2
+    messagebus.handle(commands.Allocate("order1", "LAMP", 5))
+    messagebus.handle(commands.Allocate("order2", "LAMP", 3))
+    messagebus.handle(commands.Allocate("order3", "LAMP", 2))
+    messagebus.handle(commands.Allocate("order4", "LAMP", 5))
+    messagebus.handle(commands.Allocate("order5", "LAMP", 5))
+    messagebus.handle(commands.Allocate("order6", "LAMP", 1))
+
+
+def test_delivered_exhausted_batches_leave_the_aggregate(
+    messagebus, session_factory
+):
+    make_history(messagebus)
+    session = session_factory()
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku = 'LAMP'"
+    )
+
+    archived = BatchArchiver(session_factory, pause=0).run(today)
+
+    assert archived == 2
+    product = repository.SqlAlchemyRepository(session).get("LAMP")
+    assert {b.reference for b in product.batches} == {
+        "in-stock",
+        "shipment",
+        "delivered-with-room",
+    }
+    assert product.version_number == version + 1
+    assert {
+        orderid
+        for [orderid] in session.execute("SELECT orderid FROM order_lines")
+    } == {"order1", "order5", "order6"}
+    assert BatchArchiver(session_factory).archive_once(today) == 0
+
+
+def test_archived_batches_stay_queryable(messagebus, session_factory):
+    make_history(messagebus)
+    BatchArchiver(session_factory, pause=0).run(today)
+
+    assert views.allocations("order2", messagebus.uow) == [
+        {"sku": "LAMP", "batchref": "delivered1", "qty": 3}
+    ]
+    assert views.batch_history("delivered1", messagebus.uow) == {
+        "reference": "delivered1",
+        "sku": "LAMP",
+        "qty": 5,
+        "eta": str(last_week),
+        "archived": True,
+        "allocations": [
+            {"orderid": "order2", "qty": 3},
+            {"orderid": "order3", "qty": 2},
+        ],
+    }
+    assert views.batch_history("in-stock", messagebus.uow)["allocations"] == [
+        {"orderid": "order1", "qty": 5}
+    ]
+    assert views.batch_history("missing", messagebus.uow) is None
+    assert [
+        (batch["reference"], batch["archived"])
+        for batch in views.product_history("LAMP", messagebus.uow)
+    ][:2] == [("delivered1", True), ("delivered2", True)]
+    assert len(views.product_history("LAMP", messagebus.uow)) == 5
+
+
+def test_archiving_runs_in_bounded_chunks(messagebus, session_factory):
+    for i in range(5):
+        messagebus.handle(commands.CreateBatch(f"old{i}", "RUG", 1, last_week))
+        messagebus.handle(commands.Allocate(f"order{i}", "RUG", 1))
+    archiver = BatchArchiver(session_factory, chunk_size=2, pause=0)
+
+    assert [archiver.archive_once(today) for _ in range(4)] == [2, 2, 1, 0]
+
+
+def test_archived_skus_keep_allocating(messagebus, session_factory):
+    make_history(messagebus)
+    BatchArchiver(session_factory, pause=0).run(today)
+
+    [batchref] = messagebus.handle(commands.Allocate("order7", "LAMP", 10))
+
+    assert batchref == "delivered-with-room"
+
+
+def test_batch_history_prefers_a_live_batch_reusing_an_archived_reference(
+    messagebus, session_factory
+):
+    make_history(messagebus)
+    BatchArchiver(session_factory, pause=0).run(today)
+    messagebus.handle(commands.CreateBatch("delivered1", "LAMP", 7))
+
+    history = views.batch_history("delivered1", messagebus.uow)
+
+    assert (history["qty"], history["archived"]) == (7, False)
@@ -0,0 +1,16 @@
+from allocation.adapters.dead_letters import SqlAlchemyDeadLetterStore
+from allocation.domain import events
+
+
+def test_dead_letters_are_persisted_until_removed(session_factory):
+    store = SqlAlchemyDeadLetterStore(session_factory)
+    allocated = events.Allocated("order1", "LAMP", 10, "batch1")
+    store.add("add_allocation_to_read_model", allocated, "ConnectionError()")
+    store.add("send_out_of_stock_notification", events.OutOfStock("LAMP"), "")
+
+    [(first_id, handler, event), (second_id, _, _)] = store.list()
+    assert (handler, event) == ("add_allocation_to_read_model", allocated)
+
+    store.remove(first_id)
+
+    assert [dead_letter[0] for dead_letter in store.list()] == [second_id]
@@ -0,0 +1,177 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+from allocation.adapters import repository
+from allocation.domain import model
+
+today = date.today()
+tomorrow = today + timedelta(days=1)
+later = today + timedelta(days=10)
+
+
+@pytest.fixture(
+    params=["sqlite", pytest.param("postgres", marks=pytest.mark.postgres)]
+)
+def any_session(request):
+    return request.getfixturevalue(
+        "session" if request.param == "sqlite" else "postgres_session"
+    )
+
+
+def make_product(sku, batches, lines=()):
+    product = model.Product(
+        sku,
+        [
+            model.Batch(f"{sku}-{reference}", sku, qty, eta)
+            for reference, qty, eta in batches
+        ],
+    )
+    for orderid, qty in lines:
+        product.allocate(model.OrderLine(orderid, sku, qty))
+    product.events = []
+    return product
+
+
+def save(session, product):
+    session.add(product)
+    session.commit()
+    session.expunge_all()
+
+
+def allocate_fast(session, line):
+    reference = repository.SqlAlchemyRepository(session).allocate_fast(line)
+    session.commit()
+    return reference
+
+
+def allocations(session, sku):
+    rows = session.execute(
+        "SELECT order_lines.orderid, batches.reference"
+        " FROM allocations"
+        " JOIN order_lines ON order_lines.id = allocations.orderline_id"
+        " JOIN batches ON batches.id = allocations.batch_id"
+        " WHERE batches.sku = :sku",
+        dict(sku=sku),
+    )
+    return {tuple(row) for row in rows}
+
+
+SCENARIOS = {
+    "prefers stock to shipments": (
+        [("shipment", 10, tomorrow), ("stock", 10, None)],
+        [],
+        5,
+    ),
+    "prefers earlier shipments": (
+        [("later", 10, later), ("tomorrow", 10, tomorrow)],
+        [],
+        5,
+    ),
+    "skips batches without room": (
+        [("small", 3, None), ("large", 10, tomorrow)],
+        [("order0", 1)],
+        5,
+    ),
+    "fills a batch exactly": ([("stock", 5, None)], [("order0", 1)], 4),
+    "breaks ties in batch order": (
+        [("first", 10, tomorrow), ("second", 10, tomorrow)],
+        [],
+        5,
+    ),
+    "same order, different quantity": (
+        [("stock", 10, None)],
+        [("order1", 2)],
+        3,
+    ),
+}
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_fast_allocation_matches_the_domain(any_session, random_sku, scenario):
+    batches, lines, qty = SCENARIOS[scenario]
+    sku = random_sku()
+    save(any_session, make_product(sku, batches, lines))
+    domain = make_product(sku, batches, lines)
+    line = model.OrderLine("order1", sku, qty)
+
+    reference = allocate_fast(any_session, line)
+
+    assert reference == domain.allocate(line)
+    assert allocations(any_session, sku) == {
+        (line.orderid, batch.reference)
+        for batch in domain.batches
+        for line in batch._allocations
+    }
+    product = repository.SqlAlchemyRepository(any_session).get(sku)
+    assert product.version_number == domain.version_number
+    assert {
+        (batch.reference, batch.available_quantity, batch._available_quantity)
+        for batch in product.batches
+    } == {
+        (batch.reference, batch.available_quantity, batch.available_quantity)
+        for batch in domain.batches
+    }
+
+
+@pytest.mark.parametrize(
+    "batches, lines, line",
+    [
+        ([("stock", 10, None)], [], ("order1", 11)),
+        ([("stock", 10, None)], [("order1", 2)], ("order1", 2)),
+        ([("stock", 10, None)], [], ("order1", 0)),
+    ],
+    ids=["out of stock", "already allocated", "empty line"],
+)
+def test_fast_allocation_defers_to_the_domain(
+    any_session, random_sku, batches, lines, line
+):
+    sku = random_sku()
+    saved = make_product(sku, batches, lines)
+    version = saved.version_number
+    save(any_session, saved)
+    before = allocations(any_session, sku)
+
+    orderid, qty = line
+    assert (
+        allocate_fast(any_session, model.OrderLine(orderid, sku, qty)) is None
+    )
+    assert allocations(any_session, sku) == before
+    product = repository.SqlAlchemyRepository(any_session).get(sku)
+    assert product.version_number == version
+
+
+def test_fast_allocation_of_unknown_skus_defers_to_the_domain(any_session):
+    line = model.OrderLine("order1", "MISSING-SKU", 1)
+    assert allocate_fast(any_session, line) is None
+
+
+def test_fast_allocation_matches_the_domain_over_many_lines(
+    any_session, random_sku
+):
+    rng = random.Random(1234)
+    sku = random_sku()
+    batches = [
+        (f"batch{i}", rng.randint(1, 30), rng.choice([None, today, later]))
+        for i in range(10)
+    ]
+    save(any_session, make_product(sku, batches))
+    domain = make_product(sku, batches)
+
+    for i in range(60):
+        line = model.OrderLine(f"order{i % 50}", sku, rng.randint(1, 8))
+        expected = domain.allocate(line)
+        reference = allocate_fast(any_session, line)
+        if reference is None:
+            # out of stock or a repeat, both left to the domain model
+            product = repository.SqlAlchemyRepository(any_session).get(sku)
+            assert product.allocate(line) == expected
+            any_session.commit()
+        else:
+            assert reference == expected
+
+    assert allocations(any_session, sku) == {
+        (line.orderid, batch.reference)
+        for batch in domain.batches
+        for line in batch._allocations
+    }
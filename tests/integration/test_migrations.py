@@ -0,0 +1,145 @@
+import pytest
+from allocation.adapters import migrations, repository
+from allocation.adapters.orm import start_mappers
+from allocation.domain import model
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+# the schema as it was before migrations were versioned
+BASELINE_SCHEMA = (
+    "CREATE TABLE order_lines (id INTEGER PRIMARY KEY,"
+    " sku VARCHAR(255), qty INTEGER NOT NULL, orderid VARCHAR(255))",
+    "CREATE TABLE products (sku VARCHAR(255) PRIMARY KEY)",
+    "CREATE TABLE batches (id INTEGER PRIMARY KEY, reference VARCHAR(255),"
+    " sku VARCHAR(255) REFERENCES products (sku),"
+    " _purchased_quantity INTEGER NOT NULL, eta DATE)",
+    "CREATE TABLE allocations (id INTEGER PRIMARY KEY,"
+    " orderline_id INTEGER REFERENCES order_lines (id),"
+    " batch_id INTEGER REFERENCES batches (id))",
+    "CREATE TABLE allocations_view (orderid VARCHAR(255), sku VARCHAR(255),"
+    " qty INTEGER, batchref VARCHAR(255))",
+)
+
+
+def indexes(engine, table):
+    return {
+        index["name"]: index["unique"]
+        for index in inspect(engine).get_indexes(table)
+    }
+
+
+def insert_batch(engine, reference):
+    engine.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity)"
+        " VALUES (:reference, 'LAMP', 10)",
+        reference=reference,
+    )
+
+
+@pytest.fixture
+def engine():
+    return create_engine("sqlite:///:memory:")
+
+
+def test_new_databases_are_created_at_the_latest_version(engine):
+    assert migrations.migrate(engine) == []
+
+    with engine.connect() as connection:
+        assert migrations.current_version(connection) == migrations.LATEST
+    assert indexes(engine, "batches") == {
+        "ix_batches_reference": True,
+        "ix_batches_sku": False,
+        "ix_batches_allocatable": False,
+    }
+    assert "ix_allocations_batch_id" in indexes(engine, "allocations")
+
+
+def test_migrations_upgrade_and_downgrade_the_schema(engine):
+    migrations.migrate(engine)
+
+    reverted = migrations.migrate(engine, target=0)
+
+    assert [m.version for m in reverted] == [4, 3, 2, 1]
+    assert indexes(engine, "batches") == {"ix_batches_reference": False}
+    assert indexes(engine, "allocations_view") == {}
+
+    applied = migrations.migrate(engine)
+
+    assert [m.version for m in applied] == [1, 2, 3, 4]
+    assert indexes(engine, "order_lines") == {
+        "ix_order_lines_orderid_sku": False
+    }
+    assert migrations.migrate(engine) == []
+
+
+def test_batch_references_are_unique(engine):
+    migrations.migrate(engine)
+    insert_batch(engine, "batch1")
+
+    with pytest.raises(IntegrityError):
+        insert_batch(engine, "batch1")
+
+
+def test_unique_references_fail_to_migrate_over_duplicates(engine):
+    migrations.migrate(engine, target=2)
+    insert_batch(engine, "batch1")
+    insert_batch(engine, "batch1")
+
+    with pytest.raises(IntegrityError):
+        migrations.migrate(engine)
+
+    with engine.connect() as connection:
+        assert migrations.current_version(connection) == 2
+
+
+def test_available_quantities_are_backfilled(engine):
+    migrations.migrate(engine, target=3)
+    insert_batch(engine, "batch1")
+    engine.execute(
+        "INSERT INTO order_lines (id, orderid, sku, qty)"
+        " VALUES (1, 'order1', 'LAMP', 3), (2, 'order2', 'LAMP', 4)"
+    )
+    engine.execute(
+        "INSERT INTO allocations (orderline_id, batch_id)"
+        " SELECT order_lines.id, batches.id FROM order_lines, batches"
+    )
+
+    migrations.migrate(engine)
+
+    [[available]] = engine.execute("SELECT available_quantity FROM batches")
+    assert available == 3
+
+
+def test_baseline_databases_are_upgraded_to_the_current_schema(engine):
+    for statement in BASELINE_SCHEMA:
+        engine.execute(statement)
+    engine.execute("INSERT INTO products (sku) VALUES ('LAMP')")
+    insert_batch(engine, "batch1")
+    engine.execute(
+        "INSERT INTO order_lines (id, orderid, sku, qty)"
+        " VALUES (1, 'order1', 'LAMP', 4)"
+    )
+    engine.execute(
+        "INSERT INTO allocations (orderline_id, batch_id) VALUES (1, 1)"
+    )
+
+    applied = migrations.migrate(engine)
+
+    assert [m.version for m in applied] == [1, 2, 3, 4]
+    start_mappers()
+    try:
+        session = sessionmaker(bind=engine)()
+        product = repository.SqlAlchemyRepository(session).get("LAMP")
+        assert product.version_number == 0
+        assert (
+            product.allocate(model.OrderLine("order2", "LAMP", 6)) == "batch1"
+        )
+        session.commit()
+        [[version, available]] = session.execute(
+            "SELECT version_number, available_quantity"
+            " FROM products JOIN batches USING (sku)"
+        )
+        assert (version, available) == (1, 0)
+    finally:
+        clear_mappers()
@@ -116,3 +116,41 @@ def test_retrieving_allocations(session):
     batch = session.query(model.Batch).one()
 
     assert batch._allocations == {model.OrderLine("order1", "sku1", 12)}
+
+
+def test_retrieved_batches_compute_allocated_quantity(session):
+    batch = model.Batch("batch1", "sku1", 100, eta=None)
+    batch.allocate(model.OrderLine("order1", "sku1", 10))
+    session.add(batch)
+    session.commit()
+
+    session.execute(
+        "INSERT INTO order_lines (orderid, sku, qty)"
+        ' VALUES ("order2", "sku1", 15)'
+    )
+    session.execute(
+        "INSERT INTO allocations (orderline_id, batch_id)"
+        " SELECT id, :batch_id FROM order_lines WHERE orderid = 'order2'",
+        dict(batch_id=batch.id),
+    )
+    session.commit()
+
+    retrieved = session.query(model.Batch).one()
+    assert retrieved.allocated_quaitity == 25
+    assert retrieved.available_quantity == 75
+    assert retrieved.has_consistent_allocated_quantity()
+
+
+def test_available_quantity_is_persisted_on_flush(session):
+    batch = model.Batch("batch1", "sku1", 100, eta=None)
+    session.add(batch)
+    session.commit()
+    batch.allocate(model.OrderLine("order1", "sku1", 10))
+    batch.allocate(model.OrderLine("order2", "sku1", 20))
+    session.commit()
+    batch.deallocate(model.OrderLine("order1", "sku1", 10))
+    batch._purchased_quantity = 50
+    session.commit()
+
+    [[available]] = session.execute("SELECT available_quantity FROM batches")
+    assert available == 30
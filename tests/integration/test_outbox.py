@@ -0,0 +1,81 @@
+import json
+
+from allocation.adapters.outbox import OutboxRelay
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+
+class FakePipeline:
+    def __init__(self, published):
+        self.published = published
+        self.buffered = []
+
+    def publish(self, channel, message):
+        self.buffered.append((channel, json.loads(message)))
+
+    def execute(self):
+        self.published.extend(self.buffered)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self.published)
+
+
+def allocate(session_factory, orderid, sku, qty, commits=1):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku=sku)
+        product.allocate(model.OrderLine(orderid, sku, qty))
+        for _ in range(commits):
+            uow.commit()
+
+
+def add_product(session_factory, sku, qty):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        uow.products.add(
+            model.Product(sku, [model.Batch(f"{sku}-batch", sku, qty, None)])
+        )
+        uow.commit()
+
+
+def test_commit_writes_allocated_events_to_the_outbox(session_factory):
+    add_product(session_factory, "LAMP", 10)
+    allocate(session_factory, "order1", "LAMP", 2, commits=2)
+    allocate(session_factory, "order2", "LAMP", 20)
+
+    rows = list(
+        session_factory().execute("SELECT channel, payload FROM outbox")
+    )
+
+    assert [(channel, json.loads(payload)) for channel, payload in rows] == [
+        (
+            "line_allocated",
+            dict(orderid="order1", sku="LAMP", qty=2, batchref="LAMP-batch"),
+        )
+    ]
+
+
+def test_relay_publishes_in_batches_and_deletes_relayed_rows(
+    session_factory,
+):
+    add_product(session_factory, "LAMP", 10)
+    for i in range(3):
+        allocate(session_factory, f"order{i}", "LAMP", 1)
+    redis = FakeRedis()
+    relay = OutboxRelay(session_factory, redis, batch_size=2)
+
+    assert relay.relay_once() == 2
+    assert relay.relay_once() == 1
+    assert relay.relay_once() == 0
+
+    assert [message["orderid"] for _, message in redis.published] == [
+        "order0",
+        "order1",
+        "order2",
+    ]
+    assert list(session_factory().execute("SELECT * FROM outbox")) == []
@@ -1,5 +1,10 @@
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import pytest
 from allocation.adapters import repository
 from allocation.domain import model
+from sqlalchemy import event
 
 
 def test_repository_can_save_a_batch(session):
@@ -87,3 +92,176 @@ def test_repository_can_retrieve_a_batch_with_allocations(session):
     assert retrieved.batches[0]._allocations == {
         model.OrderLine("order1", "GENERIC-SOFA", 12),
     }
+
+
+def test_repository_can_retrieve_a_product_by_batch_reference(session):
+    insert_product_batch(session, "batch1")
+    insert_batch(session, "batch2")
+
+    repo = repository.SqlAlchemyRepository(session)
+
+    assert repo.get_by_batch_reference("batch1").sku == "GENERIC-SOFA"
+    assert repo.get_by_batch_reference("batch2") is None
+    assert repo.get_by_batch_reference("missing") is None
+
+
+def insert_product_with_allocations(session, sku, batch_count):
+    product = model.Product(
+        sku,
+        [
+            model.Batch(f"{sku}-batch{i}", sku, 100, eta=None)
+            for i in range(batch_count)
+        ],
+    )
+    for i, batch in enumerate(product.batches):
+        batch.allocate(model.OrderLine(f"order{i}", sku, 1))
+    session.add(product)
+    session.commit()
+    session.expunge_all()
+
+
+@contextmanager
+def count_queries(session):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def load_aggregate(session, loading, sku):
+    repo = repository.SqlAlchemyRepository(session)
+    product = repo.get(sku, loading=loading)
+    # touch everything allocate() would
+    return {b.reference: set(b._allocations) for b in product.batches}
+
+
+@pytest.mark.parametrize(
+    "loading, queries",
+    [
+        (repository.SELECTIN, 3),
+        (repository.JOINED, 1),
+        (repository.AGGREGATE, 1),
+    ],
+)
+def test_eager_loading_uses_a_constant_number_of_queries(
+    session, loading, queries
+):
+    insert_product_with_allocations(session, "SMALL-TABLE", 1)
+    insert_product_with_allocations(session, "LARGE-TABLE", 20)
+
+    for sku, batch_count in [("SMALL-TABLE", 1), ("LARGE-TABLE", 20)]:
+        with count_queries(session) as statements:
+            allocations = load_aggregate(session, loading, sku)
+        session.expunge_all()
+
+        assert len(allocations) == batch_count
+        assert all(len(lines) == 1 for lines in allocations.values())
+        assert len(statements) == queries
+
+
+def test_lazy_loading_issues_a_query_per_batch(session):
+    insert_product_with_allocations(session, "LARGE-TABLE", 20)
+
+    with count_queries(session) as statements:
+        load_aggregate(session, repository.LAZY, "LARGE-TABLE")
+
+    assert len(statements) == 2 + 20
+
+
+@pytest.mark.parametrize(
+    "loading",
+    [
+        repository.LAZY,
+        repository.SELECTIN,
+        repository.JOINED,
+        repository.AGGREGATE,
+    ],
+)
+def test_loading_strategies_return_the_same_aggregate(session, loading):
+    insert_product_with_allocations(session, "LARGE-TABLE", 5)
+    insert_product_with_allocations(session, "EMPTY-TABLE", 0)
+    repo = repository.SqlAlchemyRepository(session, loading=loading)
+
+    product = repo.get("LARGE-TABLE")
+
+    assert [batch.reference for batch in product.batches] == [
+        f"LARGE-TABLE-batch{i}" for i in range(5)
+    ]
+    assert product.batches[3]._allocations == {
+        model.OrderLine("order3", "LARGE-TABLE", 1)
+    }
+    assert repo.get("EMPTY-TABLE").batches == []
+    assert repo.get("MISSING") is None
+    assert {product.sku for product in repo.list()} == {
+        "LARGE-TABLE",
+        "EMPTY-TABLE",
+    }
+
+
+def test_product_cache_evicts_least_recently_used_products():
+    cache = repository.ProductCache(max_size=2)
+    lamp, rug, sofa = (
+        model.Product(sku, []) for sku in ("LAMP", "RUG", "SOFA")
+    )
+    cache.put(lamp)
+    cache.put(rug)
+    cache.put(cache.checkout("LAMP"))
+
+    cache.put(sofa)
+
+    assert len(cache) == 2
+    assert cache.checkout("RUG") is None
+    assert cache.checkout("LAMP") is lamp
+    assert cache.checkout("LAMP") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_allocation_loads_only_the_batches_it_can_use(session):
+    tomorrow, later = date.today() + timedelta(
+        days=1
+    ), date.today() + timedelta(days=10)
+    full = model.Batch("full", "LAMP", 10, eta=None)
+    full.allocate(model.OrderLine("order1", "LAMP", 10))
+    product = model.Product(
+        "LAMP",
+        [
+            full,
+            model.Batch("small", "LAMP", 3, eta=None),
+            model.Batch("later", "LAMP", 20, eta=later),
+            model.Batch("tomorrow", "LAMP", 20, eta=tomorrow),
+        ],
+    )
+    session.add(product)
+    session.commit()
+    session.expunge_all()
+    repo = repository.SqlAlchemyRepository(session)
+
+    product = repo.get_for_allocation(model.OrderLine("order2", "LAMP", 5))
+
+    assert [b.reference for b in product.batches] == ["tomorrow"]
+    assert product.allocate(model.OrderLine("order2", "LAMP", 5)) == "tomorrow"
+    session.commit()
+    session.expunge_all()
+
+    product = repo.get_for_allocation(model.OrderLine("order1", "LAMP", 10))
+
+    assert [b.reference for b in product.batches] == ["full", "tomorrow"]
+    assert product.allocate(model.OrderLine("order1", "LAMP", 10)) == "full"
+    assert repo.get_for_allocation(model.OrderLine("o", "MISSING", 1)) is None
+
+
+def test_allocation_reuses_a_product_already_in_the_session(session):
+    insert_product_with_allocations(session, "LARGE-TABLE", 3)
+    repo = repository.SqlAlchemyRepository(session)
+    product = repo.get("LARGE-TABLE")
+
+    line = model.OrderLine("order9", "LARGE-TABLE", 1)
+    assert repo.get_for_allocation(line) is product
+    assert len(product.batches) == 3
@@ -1,6 +1,13 @@
+import threading
+from datetime import date, timedelta
+
 import pytest
-from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from allocation import bootstrap
+from allocation.adapters import repository
+from allocation.adapters.archive import BatchArchiver
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+from sqlalchemy import event
 
 
 def insert_batch(session, reference, sku, qty, eta):
@@ -67,3 +74,191 @@ def test_rolls_back_on_error(session_factory):
     new_session = session_factory()
     rows = list(new_session.execute('SELECT * FROM "batches"'))
     assert rows == []
+
+
+def test_concurrent_updates_to_a_product_raise_a_concurrency_error(
+    session_factory,
+):
+    session = session_factory()
+    insert_batch(session, "batch1", "DINING-CHAIR", 100, None)
+    session.commit()
+
+    first = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    second = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with first, second:
+        first_product = first.products.get(sku="DINING-CHAIR")
+        second_product = second.products.get(sku="DINING-CHAIR")
+        first_product.allocate(model.OrderLine("order1", "DINING-CHAIR", 10))
+        second_product.allocate(model.OrderLine("order2", "DINING-CHAIR", 10))
+
+        first.commit()
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            second.commit()
+    list(first.collect_new_events())
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='DINING-CHAIR'"
+    )
+    assert version == 1
+    assert get_allocated_batch_ref(session, "order1", "DINING-CHAIR")
+
+
+@pytest.mark.postgres
+def test_concurrent_allocations_never_oversell(
+    postgres_session_factory, random_sku, random_batchref, random_orderid
+):
+    sku, batchref = random_sku(), random_batchref()
+    session = postgres_session_factory()
+    insert_batch(session, batchref, sku, 10, None)
+    session.commit()
+
+    results, errors = [], []
+
+    def allocate(orderid):
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory),
+            send_mail=lambda *args, **kwargs: None,
+        )
+        bus.conflict_attempts = 50
+        try:
+            results.extend(bus.handle(commands.Allocate(orderid, sku, 1)))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            bus.shutdown()
+
+    threads = [
+        threading.Thread(target=allocate, args=(random_orderid(str(i)),))
+        for i in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    [[allocated]] = session.execute(
+        "SELECT COUNT(*) FROM allocations"
+        " JOIN batches ON batches.id = allocations.batch_id"
+        " WHERE batches.reference = :batchref",
+        dict(batchref=batchref),
+    )
+    assert errors == []
+    assert results.count(batchref) == allocated == 10
+    assert results.count(None) == 10
+
+
+def allocate_with(uow, orderid, sku, qty):
+    with uow:
+        product = uow.products.get(sku=sku)
+        batchref = product.allocate(model.OrderLine(orderid, sku, qty))
+        uow.commit()
+    list(uow.collect_new_events())
+    return batchref
+
+
+def test_cached_products_are_reused_after_a_version_check(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "CACHED-LAMP", 100, None)
+    session.commit()
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=cache)
+    allocate_with(uow, "order1", "CACHED-LAMP", 10)
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(session.get_bind(), "before_cursor_execute", listener)
+    allocate_with(uow, "order2", "CACHED-LAMP", 10)
+    event.remove(session.get_bind(), "before_cursor_execute", listener)
+
+    selects = [s for s in statements if s.startswith("SELECT")]
+    assert len(selects) == 1 and "version_number" in selects[0]
+    assert cache.hits == 1
+    assert get_allocated_batch_ref(session, "order1", "CACHED-LAMP")
+    assert get_allocated_batch_ref(session, "order2", "CACHED-LAMP")
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='CACHED-LAMP'"
+    )
+    assert cache.checkout("CACHED-LAMP").version_number == version == 2
+
+
+def test_cached_products_are_reloaded_after_outside_writes(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "CACHED-RUG", 10, None)
+    session.commit()
+    cached = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, cache=repository.ProductCache()
+    )
+    uncached = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=None)
+    allocate_with(cached, "order1", "CACHED-RUG", 5)
+
+    allocate_with(uncached, "order2", "CACHED-RUG", 5)
+
+    assert allocate_with(cached, "order3", "CACHED-RUG", 5) is None
+
+
+def test_stale_cached_products_fail_at_commit(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "CACHED-SOFA", 10, None)
+    session.commit()
+    cache = repository.ProductCache()
+    allocate_with(
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=cache),
+        "order1",
+        "CACHED-SOFA",
+        1,
+    )
+
+    first = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=cache)
+    second = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=cache)
+    with first, second:
+        first_product = first.products.get(sku="CACHED-SOFA")
+        second_product = second.products.get(sku="CACHED-SOFA")
+        first_product.allocate(model.OrderLine("order2", "CACHED-SOFA", 9))
+        second_product.allocate(model.OrderLine("order3", "CACHED-SOFA", 9))
+        first.commit()
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            second.commit()
+    list(first.collect_new_events())
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='CACHED-SOFA'"
+    )
+    assert len(cache) == 1
+    assert cache.checkout("CACHED-SOFA").version_number == version == 2
+    cache.put(first_product)
+    assert (
+        allocate_with(
+            unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=cache),
+            "order3",
+            "CACHED-SOFA",
+            9,
+        )
+        is None
+    )
+
+
+@pytest.mark.parametrize("fast_allocation", [False, True])
+def test_batches_inserted_outside_the_orm_can_be_allocated(
+    session_factory, fast_allocation
+):
+    session = session_factory()
+    yesterday = date.today() - timedelta(days=1)
+    insert_batch(session, "batch1", "RAW-LAMP", 10, yesterday)
+    insert_batch(session, "untouched", "RAW-RUG", 10, yesterday)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=None)
+
+    batchref = handlers.allocate(
+        commands.Allocate("order1", "RAW-LAMP", 4),
+        uow,
+        fast_allocation=fast_allocation,
+    )
+
+    assert batchref == "batch1"
+    assert get_allocated_batch_ref(session, "order1", "RAW-LAMP") == "batch1"
+    [[available]] = session.execute(
+        "SELECT available_quantity FROM batches WHERE reference = 'batch1'"
+    )
+    assert available == 6
+    assert BatchArchiver(session_factory).archive_once(date.today()) == 0
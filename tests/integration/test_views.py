@@ -14,7 +14,6 @@ def messagebus(session_factory):
         start_orm=False,
         uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
         send_mail=lambda *args, **kwargs: None,
-        publish=lambda *args, **kwargs: None,
     )
     return bus
 
@@ -52,3 +51,25 @@ def test_deallocation(messagebus, random_orderid):
     assert views.allocations(orderid, messagebus.uow) == [
         {"sku": "sku1", "qty": 20, "batchref": "sku2batch"},
     ]
+
+
+def test_allocate_many_view(messagebus, random_orderid):
+    orderid = random_orderid()
+    messagebus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+    messagebus.handle(commands.CreateBatch("sku2batch", "sku2", 50, today))
+
+    [batchrefs] = messagebus.handle(
+        commands.AllocateMany(
+            [
+                commands.Allocate(orderid, "sku1", 20),
+                commands.Allocate(orderid, "sku2", 20),
+            ]
+        )
+    )
+
+    assert batchrefs == ["sku1batch", "sku2batch"]
+    allocations = views.allocations(orderid, messagebus.uow)
+    assert sorted(allocations, key=lambda row: row["sku"]) == [
+        {"sku": "sku1", "batchref": "sku1batch", "qty": 20},
+        {"sku": "sku2", "batchref": "sku2batch", "qty": 20},
+    ]
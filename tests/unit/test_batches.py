@@ -98,3 +98,35 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
 
     assert batch.available_quantity == 15
+
+
+def test_deallocate_one_reduces_the_allocated_quantity():
+    batch, line = make_batch_and_line("ARM-CHAIR", 20, 5)
+    batch.allocate(line)
+
+    assert batch.deallocate_one() == line
+    assert batch.allocated_quaitity == 0
+    assert batch.available_quantity == 20
+
+
+def test_allocated_quantity_is_kept_consistent_with_allocations():
+    batch = Batch("batch-001", "ARM-CHAIR", qty=100, eta=None)
+    lines = [OrderLine(f"order-{i}", "ARM-CHAIR", i) for i in range(1, 10)]
+
+    for line in lines:
+        batch.allocate(line)
+    batch.deallocate(lines[0])
+    batch.deallocate(lines[0])
+    batch.deallocate_one()
+
+    assert batch.has_consistent_allocated_quantity()
+
+
+def test_allocated_quantity_is_recomputed_after_reset():
+    batch, line = make_batch_and_line("ARM-CHAIR", 20, 5)
+    batch._allocations.add(line)
+
+    assert not batch.has_consistent_allocated_quantity()
+    batch.reset_allocated_quantity()
+    assert batch.has_consistent_allocated_quantity()
+    assert batch.available_quantity == 15
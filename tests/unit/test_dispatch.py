@@ -0,0 +1,74 @@
+import threading
+
+from allocation.domain import events
+from allocation.service_layer.dispatch import (
+    BackgroundDispatcher,
+    fire_and_forget,
+    is_fire_and_forget,
+)
+
+
+def test_handlers_can_be_marked_fire_and_forget():
+    def handler(event):
+        pass
+
+    assert not is_fire_and_forget(handler)
+    assert is_fire_and_forget(fire_and_forget(handler))
+
+
+def test_shutdown_flushes_pending_work():
+    handled = []
+    dispatcher = BackgroundDispatcher(workers=2)
+
+    for i in range(10):
+        dispatcher.submit(handled.append, events.OutOfStock(f"sku{i}"))
+    dispatcher.shutdown()
+
+    assert len(handled) == 10
+    assert dispatcher.metrics() == dict(
+        submitted=10, completed=10, failed=0, ran_inline=0, queue_depth=0
+    )
+
+
+def test_full_queue_runs_handlers_on_the_callers_thread():
+    started, release = threading.Event(), threading.Event()
+    threads = []
+
+    def blocking_handler(event):
+        started.set()
+        release.wait(timeout=1)
+
+    def handler(event):
+        threads.append(threading.current_thread())
+
+    dispatcher = BackgroundDispatcher(workers=1, queue_size=1)
+    dispatcher.submit(blocking_handler, events.OutOfStock("sku1"))
+    started.wait(timeout=1)
+    dispatcher.submit(blocking_handler, events.OutOfStock("sku2"))
+    assert dispatcher.metrics()["queue_depth"] == 1
+
+    dispatcher.submit(handler, events.OutOfStock("sku3"))
+    release.set()
+    dispatcher.shutdown()
+
+    assert threads == [threading.current_thread()]
+    assert dispatcher.metrics()["ran_inline"] == 1
+    assert dispatcher.metrics()["completed"] == 3
+
+
+def test_failures_are_handed_to_the_retry_scheduler():
+    scheduled = []
+
+    class FakeRetryScheduler:
+        def schedule(self, handler, event, error=""):
+            scheduled.append(event)
+
+    def handler(event):
+        raise ConnectionError("redis is down")
+
+    dispatcher = BackgroundDispatcher(retries=FakeRetryScheduler())
+    dispatcher.submit(handler, events.OutOfStock("sku1"))
+    dispatcher.shutdown()
+
+    assert scheduled == [events.OutOfStock("sku1")]
+    assert dispatcher.metrics()["failed"] == 1
@@ -1,11 +1,19 @@
+import asyncio
+import contextvars
 from datetime import date
 from typing import List
 
 import pytest
 from allocation import bootstrap
 from allocation.adapters import repository
-from allocation.domain import commands, model
+from allocation.adapters.dead_letters import InMemoryDeadLetterStore
+from allocation.adapters.metrics import InMemoryMetrics
+from allocation.domain import commands, events, model
 from allocation.service_layer import handlers, unit_of_work
+from allocation.service_layer.read_model import AbstractReadModel
+from allocation.service_layer.retries import RetryScheduler
+
+from .test_retries import FakeClock
 
 
 class FakeRepository:
@@ -31,6 +39,12 @@ class FakeRepository:
             None,
         )
 
+    def get_for_allocation(self, line: model.OrderLine) -> model.Product:
+        return self.get(line.sku)
+
+    def allocate_fast(self, line: model.OrderLine):
+        return None
+
     def list(self):
         return list(self._products)
 
@@ -42,6 +56,7 @@ class FakeRepository:
 
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     def __init__(self):
+        super().__init__()
         self.products = repository.TrackingRepository(FakeRepository())
         self.committed = False
 
@@ -52,13 +67,22 @@ class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
         pass
 
 
+class FakeReadModel(AbstractReadModel):
+    def __init__(self):
+        super().__init__()
+        self.written = []
+
+    def _write(self, statements):
+        self.written.append(statements)
+
+
 @pytest.fixture
 def messagebus():
     bus = bootstrap.bootstrap(
         start_orm=False,
         uow=FakeUnitOfWork(),
         send_mail=lambda *args, **kwargs: None,
-        publish=lambda *args, **kwargs: None,
+        read_model=FakeReadModel(),
     )
     return bus
 
@@ -197,3 +221,452 @@ def test_realocates_batch_if_nessesary_when_available_quantity_reduces(
 
     assert batch1.available_quantity == 5
     assert batch2.available_quantity == 50
+
+
+def test_change_batch_quantity_uses_the_injected_policy():
+    released = []
+
+    def release_everything(lines, excess):
+        released.extend(line.orderid for line in lines)
+        return list(lines)
+
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        send_mail=lambda *args, **kwargs: None,
+        read_model=FakeReadModel(),
+        deallocation_policy=release_everything,
+    )
+    history = [
+        commands.CreateBatch(reference="batch1", sku="SHINY-TABLE", qty=10),
+        commands.Allocate(orderid="order1", sku="SHINY-TABLE", qty=2),
+        commands.Allocate(orderid="order2", sku="SHINY-TABLE", qty=8),
+        commands.ChangeBatchQuantity(reference="batch1", qty=8),
+    ]
+    for message in history:
+        bus.handle(message)
+
+    # fewest_lines would only have released order1
+    assert sorted(released) == ["order1", "order2"]
+
+
+def test_rebalance_moves_lines_between_batches(messagebus):
+    history = [
+        commands.CreateBatch(reference="batch1", sku="SHINY-RUG", qty=10),
+        commands.CreateBatch(
+            reference="batch2", sku="SHINY-RUG", qty=10, eta=date.today()
+        ),
+        commands.Allocate(orderid="order1", sku="SHINY-RUG", qty=4),
+        commands.Allocate(orderid="order2", sku="SHINY-RUG", qty=5),
+        commands.Allocate(orderid="order3", sku="SHINY-RUG", qty=6),
+        commands.Deallocate(orderid="order2", sku="SHINY-RUG", qty=5),
+    ]
+    for message in history:
+        messagebus.handle(message)
+    [batch1, batch2] = messagebus.uow.products.get("SHINY-RUG").batches
+    assert batch2.available_quantity == 4
+
+    reallocations, read_model = messagebus.buffers
+    read_model.written.clear()
+
+    [moved] = messagebus.handle(commands.Rebalance(sku="SHINY-RUG"))
+
+    assert moved == 1
+    assert batch1.available_quantity == 0
+    assert batch2.available_quantity == 10
+    assert len(reallocations) == 0
+    [[(delete, deleted), (insert, inserted)]] = read_model.written
+    assert delete.startswith("DELETE") and deleted == [
+        dict(orderid="order3", sku="SHINY-RUG")
+    ]
+    assert insert.startswith("INSERT") and inserted == [
+        dict(orderid="order3", sku="SHINY-RUG", qty=6, batchref="batch1")
+    ]
+
+
+def test_rebalance_errors_for_invalid_sku(messagebus):
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku NOSUCHSKU"):
+        messagebus.handle(commands.Rebalance(sku="NOSUCHSKU"))
+
+
+def test_allocate_many_returns_an_allocation_per_line(messagebus):
+    history = [
+        commands.CreateBatch(reference="batch1", sku="BLUE-VASE", qty=10),
+        commands.CreateBatch(reference="batch2", sku="RED-VASE", qty=10),
+    ]
+    for message in history:
+        messagebus.handle(message)
+
+    [batchrefs] = messagebus.handle(
+        commands.AllocateMany(
+            [
+                commands.Allocate(orderid="order1", sku="BLUE-VASE", qty=6),
+                commands.Allocate(orderid="order1", sku="RED-VASE", qty=6),
+                commands.Allocate(orderid="order2", sku="BLUE-VASE", qty=6),
+            ]
+        )
+    )
+
+    assert batchrefs == ["batch1", "batch2", None]
+    assert messagebus.uow.committed
+
+
+def test_allocate_many_errors_for_invalid_sku(messagebus):
+    messagebus.handle(
+        commands.CreateBatch(reference="batch1", sku="BLUE-VASE", qty=10)
+    )
+
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku NOSUCHSKU"):
+        messagebus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate(orderid="o1", sku="BLUE-VASE", qty=1),
+                    commands.Allocate(orderid="o1", sku="NOSUCHSKU", qty=1),
+                ]
+            )
+        )
+    [batch] = messagebus.uow.products.get("BLUE-VASE").batches
+    assert batch.available_quantity == 10
+
+
+def test_read_model_is_written_once_per_message(messagebus):
+    history = [
+        commands.CreateBatch(reference="batch1", sku="TALL-LAMP", qty=10),
+        commands.CreateBatch(
+            reference="batch2", sku="TALL-LAMP", qty=10, eta=date.today()
+        ),
+        commands.Allocate(orderid="order1", sku="TALL-LAMP", qty=2),
+        commands.Allocate(orderid="order2", sku="TALL-LAMP", qty=2),
+        commands.Allocate(orderid="order3", sku="TALL-LAMP", qty=2),
+    ]
+    for message in history:
+        messagebus.handle(message)
+    read_model = messagebus.buffers[-1]
+    read_model.written.clear()
+
+    messagebus.handle(commands.ChangeBatchQuantity(reference="batch1", qty=1))
+
+    [statements] = read_model.written
+    [(delete, deleted), (insert, inserted)] = statements
+    assert delete.startswith("DELETE") and len(deleted) == 3
+    assert insert.startswith("INSERT") and len(inserted) == 3
+    assert {row["batchref"] for row in inserted} == {"batch2"}
+
+
+def test_failing_event_handlers_are_scheduled_for_retry():
+    scheduled = []
+
+    class FakeRetryScheduler:
+        def schedule(self, handler, event, error=""):
+            scheduled.append((handler.__name__, event))
+
+    def send_mail(*args):
+        raise ConnectionError("SMTP is down")
+
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        send_mail=send_mail,
+        read_model=FakeReadModel(),
+        retries=FakeRetryScheduler(),
+    )
+    bus.handle(commands.CreateBatch(reference="batch1", sku="RUG", qty=1))
+
+    [batchref] = bus.handle(commands.Allocate(orderid="o1", sku="RUG", qty=5))
+    bus.dispatcher.shutdown()
+
+    assert batchref is None
+    assert scheduled == [
+        ("send_out_of_stock_notification", events.OutOfStock("RUG"))
+    ]
+
+
+class FlakyReadModel(FakeReadModel):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def _write(self, statements):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("database is down")
+        super()._write(statements)
+
+
+def make_bus_with_flaky_read_model(failures, max_attempts):
+    retries = RetryScheduler(
+        InMemoryDeadLetterStore(),
+        max_attempts=max_attempts,
+        backoff=10,
+        clock=FakeClock(),
+        background=False,
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        send_mail=lambda *args, **kwargs: None,
+        read_model=FlakyReadModel(failures),
+        retries=retries,
+    )
+    bus.handle(commands.CreateBatch(reference="batch1", sku="RUG", qty=10))
+    return bus
+
+
+def written_rows(read_model):
+    return [
+        (statement.split()[0], params["orderid"])
+        for statements in read_model.written
+        for statement, rows in statements
+        for params in rows
+    ]
+
+
+def test_failed_buffer_flushes_are_retried_in_order():
+    bus = make_bus_with_flaky_read_model(failures=1, max_attempts=3)
+    read_model = bus.buffers[-1]
+
+    bus.handle(commands.Allocate(orderid="o1", sku="RUG", qty=1))
+    bus.handle(commands.ChangeBatchQuantity(reference="batch1", qty=0))
+    assert written_rows(read_model) == []
+
+    bus.retries.clock.now += 10
+    bus.handle(commands.CreateBatch(reference="batch2", sku="LAMP", qty=1))
+
+    assert written_rows(read_model) == [("INSERT", "o1"), ("DELETE", "o1")]
+
+
+def test_failed_buffer_flushes_are_dead_lettered_and_can_be_replayed():
+    bus = make_bus_with_flaky_read_model(failures=1, max_attempts=1)
+
+    bus.handle(commands.Allocate(orderid="o1", sku="RUG", qty=1))
+
+    [(_, handler, event)] = bus.retries.dead_letters.list()
+    assert handler == "add_allocation_to_read_model"
+    assert event == events.Allocated("o1", "RUG", 1, "batch1")
+
+    assert bus.replay_dead_letters() == 1
+    assert len(bus.buffers[-1].written) == 1
+
+
+def test_unit_tests_keep_dead_letters_in_memory(messagebus):
+    assert isinstance(messagebus.retries.dead_letters, InMemoryDeadLetterStore)
+
+
+def test_messagebus_records_handler_metrics():
+    class FakeRetryScheduler:
+        def schedule(self, handler, event, error=""):
+            pass
+
+    def failing_handler(event):
+        raise ConnectionError("down")
+
+    metrics = InMemoryMetrics()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        send_mail=lambda *args, **kwargs: None,
+        read_model=FakeReadModel(),
+        retries=FakeRetryScheduler(),
+        metrics=metrics,
+    )
+    bus.event_handlers[events.Allocated] = [failing_handler]
+    bus.handle(commands.CreateBatch(reference="batch1", sku="RUG", qty=10))
+    bus.handle(commands.Allocate(orderid="o1", sku="RUG", qty=5))
+    bus.dispatcher.shutdown()
+
+    allocate = (("handler", "allocate"), ("message", "Allocate"))
+    failing = (("handler", "failing_handler"), ("message", "Allocated"))
+    assert metrics.histograms["messagebus_handler_seconds", allocate].count == 1
+    assert metrics.histograms["messagebus_handler_seconds", failing].count == 1
+    assert metrics.counters["messagebus_handler_errors_total", failing] == 1
+    assert metrics.counters["messagebus_handler_retries_total", failing] == 1
+    assert metrics.gauges["messagebus_queue_depth", allocate[1:]] == 1
+    create = (("message", "CreateBatch"),)
+    assert metrics.gauges["messagebus_queue_depth", create] == 1
+
+
+def test_commands_are_retried_on_concurrency_errors(messagebus):
+    attempts = []
+
+    def conflicting_handler(command):
+        attempts.append(command)
+        if len(attempts) < 3:
+            raise unit_of_work.ConcurrencyError()
+        return "batch1"
+
+    messagebus.command_handlers[commands.Allocate] = conflicting_handler
+
+    [batchref] = messagebus.handle(commands.Allocate("o1", "RUG", 1))
+
+    assert batchref == "batch1"
+    assert len(attempts) == 3
+
+
+def test_commands_give_up_after_repeated_conflicts(messagebus):
+    def conflicting_handler(command):
+        raise unit_of_work.ConcurrencyError()
+
+    messagebus.command_handlers[commands.Allocate] = conflicting_handler
+    messagebus.conflict_attempts = 2
+
+    with pytest.raises(unit_of_work.ConcurrencyError):
+        messagebus.handle(commands.Allocate("o1", "RUG", 1))
+
+
+def test_injected_handlers_keep_their_name_and_markers():
+    def handler(message, uow, send_mail):
+        return message, uow, send_mail
+
+    handler.fire_and_forget = True
+    injected = bootstrap.inject_dependencies(
+        handler, {"uow": "uow", "send_mail": "mail", "publish": "unused"}
+    )
+
+    assert injected("message") == ("message", "uow", "mail")
+    assert injected.__name__ == "handler"
+    assert injected.fire_and_forget
+
+
+def test_messagebus_rejects_unknown_message_types(messagebus):
+    with pytest.raises(TypeError, match="Unknown message type"):
+        messagebus.handle("not a message")
+
+
+@pytest.fixture
+def async_messagebus():
+    async def send_mail(*args):
+        sent.append(args)
+
+    sent = []
+    bus = bootstrap.bootstrap_async(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        send_mail=send_mail,
+        read_model=FakeReadModel(),
+    )
+    bus.sent = sent
+    return bus
+
+
+def test_async_messagebus_awaits_coroutine_adapters(async_messagebus):
+    async def allocate():
+        await async_messagebus.handle(
+            commands.CreateBatch(reference="batch1", sku="PINK-LAMP", qty=1)
+        )
+        return await async_messagebus.handle(
+            commands.Allocate(orderid="order1", sku="PINK-LAMP", qty=2)
+        )
+
+    [batchref] = asyncio.run(allocate())
+    async_messagebus.dispatcher.shutdown()
+
+    assert batchref is None
+    assert async_messagebus.sent == [
+        ("stock-admin@made.com", "Out of stock: PINK-LAMP")
+    ]
+
+
+def test_async_messagebus_runs_event_handlers_concurrently(async_messagebus):
+    completed = []
+
+    async def handle():
+        first_started, second_started = asyncio.Event(), asyncio.Event()
+
+        async def first(event):
+            first_started.set()
+            await asyncio.wait_for(second_started.wait(), timeout=1)
+            completed.append("first")
+
+        async def second(event):
+            second_started.set()
+            await asyncio.wait_for(first_started.wait(), timeout=1)
+            completed.append("second")
+
+        async_messagebus.event_handlers[events.OutOfStock] = [first, second]
+        await async_messagebus.handle(
+            commands.CreateBatch(reference="batch1", sku="PINK-LAMP", qty=1)
+        )
+        await async_messagebus.handle(
+            commands.Allocate(orderid="order1", sku="PINK-LAMP", qty=2)
+        )
+
+    asyncio.run(handle())
+
+    assert sorted(completed) == ["first", "second"]
+
+
+def test_concurrent_async_handle_calls_keep_their_own_messages(
+    async_messagebus,
+):
+    caller = contextvars.ContextVar("caller")
+    handled = []
+
+    async def handle():
+        second_started, second_done = asyncio.Event(), asyncio.Event()
+
+        async def record(event):
+            if caller.get() == "first":
+                second_started.set()
+                await asyncio.wait_for(second_done.wait(), timeout=1)
+            handled.append((caller.get(), event.orderid))
+
+        async def first():
+            caller.set("first")
+            for message in [
+                commands.CreateBatch(reference="batch1", sku="LAMP", qty=10),
+                commands.Allocate(orderid="order1", sku="LAMP", qty=5),
+                commands.Allocate(orderid="order2", sku="LAMP", qty=5),
+            ]:
+                await async_messagebus.handle(message)
+            async_messagebus.event_handlers[events.Deallocated] = [record]
+            await async_messagebus.handle(
+                commands.ChangeBatchQuantity(reference="batch1", qty=0)
+            )
+
+        async def second():
+            caller.set("second")
+            await second_started.wait()
+            await async_messagebus.handle(
+                commands.CreateBatch(reference="batch2", sku="RUG", qty=10)
+            )
+            result = await async_messagebus.handle(
+                commands.Allocate(orderid="order3", sku="RUG", qty=1)
+            )
+            second_done.set()
+            return result
+
+        _, result = await asyncio.gather(first(), second())
+        return result
+
+    assert asyncio.run(handle()) == ["batch2"]
+    async_messagebus.dispatcher.shutdown()
+    assert sorted(handled) == [("first", "order1"), ("first", "order2")]
+
+
+def test_fast_allocations_raise_the_same_events():
+    class FastRepository(FakeRepository):
+        def allocate_fast(self, line):
+            return "batch1" if line.orderid == "fast" else None
+
+    uow = FakeUnitOfWork()
+    uow.products = repository.TrackingRepository(FastRepository())
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        send_mail=lambda *args, **kwargs: None,
+        read_model=FakeReadModel(),
+        fast_allocation=True,
+    )
+    bus.handle(commands.CreateBatch(reference="batch1", sku="RUG", qty=10))
+    read_model = bus.buffers[-1]
+
+    [fast] = bus.handle(commands.Allocate("fast", "RUG", 1))
+    [slow] = bus.handle(commands.Allocate("slow", "RUG", 1))
+
+    assert fast == slow == "batch1"
+    assert [
+        params["orderid"]
+        for statements in read_model.written
+        for _, rows in statements
+        for params in rows
+    ] == ["fast", "slow"]
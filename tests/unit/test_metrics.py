@@ -0,0 +1,63 @@
+import socket
+
+from allocation.adapters.metrics import (
+    InMemoryMetrics,
+    PrometheusMetrics,
+    StatsdMetrics,
+)
+
+LABELS = (("handler", "allocate"), ("message", "Allocate"))
+
+
+def test_histograms_count_observations_per_labels():
+    metrics = InMemoryMetrics()
+    metrics.observe("seconds", 0.002, LABELS)
+    metrics.observe("seconds", 0.2, LABELS)
+    metrics.observe("seconds", 0.2, (("handler", "other"),))
+
+    histogram = metrics.histograms["seconds", LABELS]
+
+    assert histogram.count == 2
+    assert histogram.sum == 0.202
+
+
+def test_prometheus_text_format():
+    metrics = PrometheusMetrics()
+    metrics.observe("seconds", 0.002, LABELS)
+    metrics.increment("errors_total", LABELS)
+    metrics.gauge("queue_depth", 3)
+
+    lines = metrics.render().splitlines()
+
+    assert "# TYPE seconds histogram" in lines
+    assert (
+        'seconds_bucket{handler="allocate",message="Allocate",le="0.001"} 0'
+        in lines
+    )
+    assert (
+        'seconds_bucket{handler="allocate",message="Allocate",le="0.005"} 1'
+        in lines
+    )
+    assert (
+        'seconds_bucket{handler="allocate",message="Allocate",le="+Inf"} 1'
+        in lines
+    )
+    assert 'seconds_count{handler="allocate",message="Allocate"} 1' in lines
+    assert "# TYPE errors_total counter" in lines
+    assert 'errors_total{handler="allocate",message="Allocate"} 1' in lines
+    assert "queue_depth 3" in lines
+
+
+def test_statsd_sends_udp_datagrams():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(1)
+    metrics = StatsdMetrics(*receiver.getsockname())
+
+    metrics.observe("seconds", 0.0015, LABELS)
+    metrics.increment("errors_total")
+
+    assert receiver.recv(1024) == (
+        b"allocation.seconds:1.500|ms|#handler:allocate,message:Allocate"
+    )
+    assert receiver.recv(1024) == b"allocation.errors_total:1|c"
@@ -1,8 +1,8 @@
 from datetime import date, timedelta
 
 import pytest
-from allocation.domain.events import OutOfStock
-from allocation.domain.model import Batch, OrderLine, Product
+from allocation.domain.events import Deallocated, OutOfStock, Rebalanced
+from allocation.domain.model import Batch, OrderLine, Product, any_lines
 
 today = date.today()
 tomorrow = today + timedelta(days=1)
@@ -60,3 +60,238 @@ def test_raises_out_of_stock_exception_if_cannot_allocate():
     allocation = product.allocate(line2)
     assert product.events[-1] == OutOfStock(sku="SMALL-TABLE")
     assert allocation is None
+
+
+def test_allocation_skips_exhausted_batches():
+    in_stock_batch = Batch("batch-001", "BIG-SOFA", qty=5, eta=None)
+    shipment_batch = Batch("batch-002", "BIG-SOFA", qty=20, eta=today)
+    product = Product(sku="BIG-SOFA", batches=[shipment_batch, in_stock_batch])
+
+    assert product.allocate(OrderLine("order-1", "BIG-SOFA", 5)) == "batch-001"
+    assert list(product.allocatable_batches) == [shipment_batch]
+    assert product.allocate(OrderLine("order-2", "BIG-SOFA", 5)) == "batch-002"
+
+
+def test_added_batches_are_ordered_by_eta():
+    later_batch = Batch("batch-001", "MINI-SPOON", qty=20, eta=later)
+    product = Product(sku="MINI-SPOON", batches=[later_batch])
+    product.allocate(OrderLine("order-1", "MINI-SPOON", 5))
+
+    tomorrows_batch = Batch("batch-002", "MINI-SPOON", qty=20, eta=tomorrow)
+    product.add_batch(tomorrows_batch)
+
+    assert list(product.allocatable_batches) == [tomorrows_batch, later_batch]
+    assert product.allocate(OrderLine("order-2", "MINI-SPOON", 5)) == (
+        "batch-002"
+    )
+
+
+def test_deallocation_returns_exhausted_batch_to_allocatable_batches():
+    batch = Batch("batch-001", "SMALL-TABLE", qty=5, eta=today)
+    line = OrderLine("order-1", "SMALL-TABLE", 5)
+    product = Product(sku="SMALL-TABLE", batches=[batch])
+    product.allocate(line)
+    assert list(product.allocatable_batches) == []
+
+    product.deallocate(line)
+
+    assert list(product.allocatable_batches) == [batch]
+
+
+def test_increasing_batch_quantity_makes_batch_allocatable_again():
+    batch = Batch("batch-001", "SMALL-TABLE", qty=5, eta=today)
+    product = Product(sku="SMALL-TABLE", batches=[batch])
+    product.allocate(OrderLine("order-1", "SMALL-TABLE", 5))
+
+    product.change_batch_quantity("batch-001", 10)
+
+    assert product.allocate(OrderLine("order-2", "SMALL-TABLE", 5)) == (
+        "batch-001"
+    )
+
+
+def test_deallocates_line_from_the_batch_holding_it():
+    in_stock_batch = Batch("batch-001", "BIG-SOFA", qty=20, eta=None)
+    shipment_batch = Batch("batch-002", "BIG-SOFA", qty=20, eta=today)
+    product = Product(sku="BIG-SOFA", batches=[in_stock_batch, shipment_batch])
+    line = OrderLine("order-123", "BIG-SOFA", 5)
+    product.allocate(line)
+    assert product.batches_by_line == {line: in_stock_batch}
+
+    product.deallocate(line)
+
+    assert product.batches_by_line == {}
+    assert in_stock_batch.available_quantity == 20
+
+
+def test_line_index_is_rebuilt_from_existing_allocations():
+    batch = Batch("batch-001", "BIG-SOFA", qty=20, eta=None)
+    line = OrderLine("order-123", "BIG-SOFA", 5)
+    batch.allocate(line)
+    product = Product(sku="BIG-SOFA", batches=[batch])
+
+    product.deallocate(line)
+
+    assert batch.available_quantity == 20
+
+
+def test_allocating_an_allocated_line_returns_its_batch():
+    in_stock_batch = Batch("batch-001", "BIG-SOFA", qty=5, eta=None)
+    shipment_batch = Batch("batch-002", "BIG-SOFA", qty=20, eta=today)
+    product = Product(sku="BIG-SOFA", batches=[in_stock_batch, shipment_batch])
+    line = OrderLine("order-123", "BIG-SOFA", 5)
+    product.allocate(line)
+
+    assert product.allocate(line) == "batch-001"
+    assert shipment_batch.available_quantity == 20
+    assert len(product.events) == 1
+
+
+def test_change_batch_quantity_finds_batches_added_later():
+    product = Product(sku="SMALL-TABLE", batches=[])
+    product.batches_by_reference
+    batch = Batch("batch-001", "SMALL-TABLE", qty=5, eta=today)
+    product.add_batch(batch)
+
+    product.change_batch_quantity("batch-001", 10)
+
+    assert product.batches_by_reference == {"batch-001": batch}
+    assert batch.available_quantity == 10
+
+
+def test_allocate_many_matches_repeated_allocate():
+    def make_product():
+        return Product(
+            sku="LAMP",
+            batches=[
+                Batch(f"batch-{i}", "LAMP", qty=qty, eta=eta)
+                for i, (qty, eta) in enumerate(
+                    [(10, later), (3, None), (7, tomorrow), (5, None)]
+                )
+            ],
+        )
+
+    lines = [
+        OrderLine(f"order-{i}", "LAMP", qty)
+        for i, qty in enumerate([2, 4, 1, 6, 3, 0, 5, 9, 2, 1, 4])
+    ]
+    lines.append(lines[0])
+    lines.append(OrderLine("order-other", "SOFA", 1))
+
+    one_by_one = make_product()
+    expected = [one_by_one.allocate(line) for line in lines]
+    in_bulk = make_product()
+
+    assert in_bulk.allocate_many(lines) == expected
+    assert in_bulk.events == one_by_one.events
+    assert [b.available_quantity for b in in_bulk.batches] == [
+        b.available_quantity for b in one_by_one.batches
+    ]
+
+
+def make_product_with_allocations(quantities):
+    batch = Batch("batch-001", "SMALL-TABLE", qty=sum(quantities), eta=None)
+    product = Product(sku="SMALL-TABLE", batches=[batch])
+    for i, qty in enumerate(quantities):
+        product.allocate(OrderLine(f"order-{i}", "SMALL-TABLE", qty))
+    product.events.clear()
+    return product, batch
+
+
+def test_change_batch_quantity_deallocates_fewest_lines():
+    product, batch = make_product_with_allocations([1, 1, 1, 1, 8, 5, 3])
+
+    product.change_batch_quantity("batch-001", 15)
+
+    assert product.events == [Deallocated("order-5", "SMALL-TABLE", 5)]
+    assert batch.available_quantity == 0
+
+
+def test_change_batch_quantity_deallocates_largest_lines_first():
+    product, batch = make_product_with_allocations([1, 2, 3, 8, 5])
+
+    product.change_batch_quantity("batch-001", 4)
+
+    assert product.events == [
+        Deallocated("order-3", "SMALL-TABLE", 8),
+        Deallocated("order-4", "SMALL-TABLE", 5),
+        Deallocated("order-1", "SMALL-TABLE", 2),
+    ]
+    assert batch.available_quantity == 0
+    assert product.batches_by_line.keys() == {
+        OrderLine("order-0", "SMALL-TABLE", 1),
+        OrderLine("order-2", "SMALL-TABLE", 3),
+    }
+
+
+def test_change_batch_quantity_accepts_a_policy():
+    product, batch = make_product_with_allocations([1, 1, 1, 1])
+
+    product.change_batch_quantity("batch-001", 2, policy=any_lines)
+
+    assert len(product.events) == 2
+    assert batch.available_quantity == 0
+
+
+def test_rebalance_packs_lines_to_free_larger_blocks():
+    first_batch = Batch("batch-001", "LAMP", qty=10, eta=None)
+    second_batch = Batch("batch-002", "LAMP", qty=10, eta=today)
+    product = Product(sku="LAMP", batches=[first_batch, second_batch])
+    small, large = (
+        OrderLine("order-1", "LAMP", 4),
+        OrderLine("order-2", "LAMP", 6),
+    )
+    product.allocate(small)
+    product.allocate(OrderLine("order-3", "LAMP", 5))
+    product.allocate(large)
+    product.deallocate(OrderLine("order-3", "LAMP", 5))
+    product.events.clear()
+    assert product.batches_by_line == {small: first_batch, large: second_batch}
+    assert product.allocate(OrderLine("order-4", "LAMP", 10)) is None
+    product.events.clear()
+
+    assert product.rebalance() == 1
+
+    assert product.batches_by_line == {small: first_batch, large: first_batch}
+    assert product.events == [Rebalanced("order-2", "LAMP", 6, "batch-001")]
+    assert product.allocate(OrderLine("order-4", "LAMP", 10)) == "batch-002"
+
+
+def test_rebalance_keeps_allocations_that_are_already_packed():
+    batch = Batch("batch-001", "LAMP", qty=10, eta=None)
+    product = Product(sku="LAMP", batches=[batch])
+    product.allocate(OrderLine("order-1", "LAMP", 4))
+    product.events.clear()
+
+    assert product.rebalance() == 0
+    assert product.events == []
+
+
+def test_rebalance_never_moves_a_line_onto_a_later_batch():
+    in_stock = Batch("in-stock", "LAMP", qty=10, eta=None)
+    shipment = Batch("shipment", "LAMP", qty=10, eta=tomorrow)
+    product = Product(sku="LAMP", batches=[in_stock, shipment])
+    for i, qty in enumerate([3, 3, 7]):
+        product.allocate(OrderLine(f"order-{i}", "LAMP", qty))
+    product.events.clear()
+    allocations = dict(product.batches_by_line)
+    assert list(allocations.values()) == [in_stock, in_stock, shipment]
+
+    assert product.rebalance() == 0
+
+    assert product.batches_by_line == allocations
+    assert product.events == []
+
+
+def test_changes_bump_the_version_number():
+    batch = Batch("batch1", "LAMP", 10, eta=None)
+    product = Product(sku="LAMP", batches=[batch])
+
+    product.allocate(OrderLine("order1", "LAMP", 2))
+    assert product.version_number == 1
+
+    product.allocate(OrderLine("order2", "LAMP", 20))
+    assert product.version_number == 1
+
+    product.deallocate(OrderLine("order1", "LAMP", 2))
+    assert product.version_number == 2
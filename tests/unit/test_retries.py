@@ -0,0 +1,119 @@
+import time
+
+from allocation.adapters.dead_letters import AbstractDeadLetterStore
+from allocation.domain import events
+from allocation.service_layer.retries import RetryScheduler
+
+
+class FakeDeadLetterStore(AbstractDeadLetterStore):
+    def __init__(self):
+        self.dead_letters = []
+
+    def add(self, handler, event, error):
+        self.dead_letters.append((len(self.dead_letters), handler, event))
+
+    def list(self):
+        return list(self.dead_letters)
+
+    def remove(self, dead_letter_id):
+        self.dead_letters = [
+            dead_letter
+            for dead_letter in self.dead_letters
+            if dead_letter[0] != dead_letter_id
+        ]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FlakyHandler:
+    __name__ = "flaky_handler"
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.handled = []
+
+    def __call__(self, event):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("flaky")
+        self.handled.append(event)
+
+
+def make_scheduler():
+    clock = FakeClock()
+    scheduler = RetryScheduler(
+        FakeDeadLetterStore(), max_attempts=3, clock=clock, background=False
+    )
+    return scheduler, clock
+
+
+def test_retries_are_run_once_their_backoff_has_passed():
+    scheduler, clock = make_scheduler()
+    handler = FlakyHandler(failures=0)
+    event = events.OutOfStock("LAMP")
+
+    scheduler.schedule(handler, event)
+    scheduler.run_pending()
+    assert handler.handled == []
+
+    clock.now = 2.0
+    scheduler.run_pending()
+
+    assert handler.handled == [event]
+    assert len(scheduler) == 0
+    assert scheduler.failures["flaky_handler"] == 1
+
+
+def test_backoff_grows_with_each_attempt():
+    scheduler, clock = make_scheduler()
+    handler = FlakyHandler(failures=1)
+    event = events.OutOfStock("LAMP")
+
+    scheduler.schedule(handler, event)
+    clock.now = 2.0
+    scheduler.run_pending()
+    clock.now = 5.9
+    scheduler.run_pending()
+    assert handler.handled == []
+
+    clock.now = 6.0
+    scheduler.run_pending()
+
+    assert handler.handled == [event]
+
+
+def test_exhausted_events_are_dead_lettered_and_can_be_replayed():
+    scheduler, clock = make_scheduler()
+    handler = FlakyHandler(failures=2)
+    event = events.OutOfStock("LAMP")
+
+    scheduler.schedule(handler, event)
+    for clock.now in (2.0, 6.0):
+        scheduler.run_pending()
+
+    assert scheduler.dead_letters.list() == [(0, "flaky_handler", event)]
+    assert scheduler.failures["flaky_handler"] == 3
+
+    assert scheduler.replay({"flaky_handler": handler}) == 1
+    assert handler.handled == [event]
+    assert scheduler.dead_letters.list() == []
+
+
+def test_background_worker_runs_retries():
+    scheduler = RetryScheduler(FakeDeadLetterStore(), backoff=0.01)
+    handler = FlakyHandler(failures=0)
+    event = events.OutOfStock("LAMP")
+
+    scheduler.schedule(handler, event)
+    deadline = time.monotonic() + 1
+    while not handler.handled and time.monotonic() < deadline:
+        time.sleep(0.01)
+    scheduler.shutdown()
+
+    assert handler.handled == [event]
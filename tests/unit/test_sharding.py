@@ -0,0 +1,112 @@
+import os
+import time
+
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer import handlers
+from allocation.service_layer.sharding import (
+    ShardedMessageBus,
+    ShardUnavailable,
+    shard_for_sku,
+)
+
+from .test_handlers import FakeReadModel, FakeUnitOfWork
+
+
+def fake_bus():
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        send_mail=lambda *args, **kwargs: None,
+        read_model=FakeReadModel(),
+    )
+
+
+def crash_on_create_batch():
+    bus = fake_bus()
+    bus.command_handlers[commands.CreateBatch] = lambda command: os._exit(1)
+    return bus
+
+
+def stall_on_create_batch():
+    bus = fake_bus()
+    bus.command_handlers[commands.CreateBatch] = lambda c: time.sleep(0.5)
+    return bus
+
+
+@pytest.fixture(scope="module")
+def sharded_messagebus():
+    bus = ShardedMessageBus(fake_bus, shards=2, uow=FakeUnitOfWork())
+    yield bus
+    bus.shutdown()
+
+
+def test_skus_are_routed_to_the_same_shard_every_time():
+    assert shard_for_sku("LAMP", 4) == shard_for_sku("LAMP", 4)
+    assert {shard_for_sku(f"sku{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_commands_return_results_from_their_shard(sharded_messagebus):
+    skus = [f"SKU-{i}" for i in range(6)]
+    for sku in skus:
+        sharded_messagebus.handle(commands.CreateBatch(f"{sku}-b", sku, 10))
+
+    results = [
+        sharded_messagebus.handle(commands.Allocate("o1", sku, 4))
+        for sku in skus
+    ]
+
+    assert results == [[f"{sku}-b"] for sku in skus]
+
+
+def test_batch_references_are_routed_by_their_sku(sharded_messagebus):
+    bus = sharded_messagebus
+    bus.handle(commands.CreateBatch("early", "CHAIR", 10))
+    bus.handle(commands.CreateBatch("late", "CHAIR", 10))
+    bus.handle(commands.Allocate("o1", "CHAIR", 8))
+
+    bus.handle(commands.ChangeBatchQuantity("early", 5))
+
+    assert bus.handle(commands.Allocate("o1", "CHAIR", 8)) == ["late"]
+
+
+def test_allocate_many_is_split_across_shards(sharded_messagebus):
+    skus = [f"TABLE-{i}" for i in range(6)]
+    for sku in skus:
+        sharded_messagebus.handle(commands.CreateBatch(f"{sku}-b", sku, 10))
+    lines = [commands.Allocate(f"o{i}", sku, 1) for i, sku in enumerate(skus)]
+
+    [batchrefs] = sharded_messagebus.handle(commands.AllocateMany(lines))
+
+    assert batchrefs == [f"{sku}-b" for sku in skus]
+
+
+def test_shard_errors_are_raised_to_the_caller(sharded_messagebus):
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku NOPE"):
+        sharded_messagebus.handle(commands.Allocate("o1", "NOPE", 1))
+
+
+def test_crashed_shards_fail_their_requests_and_restart():
+    bus = ShardedMessageBus(
+        crash_on_create_batch, shards=1, uow=FakeUnitOfWork()
+    )
+    try:
+        with pytest.raises(ShardUnavailable, match="exited with code 1"):
+            bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "LAMP", 1))
+    finally:
+        bus.shutdown()
+
+
+def test_slow_shards_time_out():
+    bus = ShardedMessageBus(
+        stall_on_create_batch, shards=1, uow=FakeUnitOfWork(), timeout=0.1
+    )
+    try:
+        with pytest.raises(ShardUnavailable, match="did not answer"):
+            bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+    finally:
+        bus.shutdown()